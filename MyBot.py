@@ -1,47 +1,619 @@
 # Importing libraries and modules
+import time
+STARTED_AT = time.perf_counter()  # cold start and time to ready are measured from here
 import os
-import re
 import discord
-import yt_dlp
 import asyncio
+import hashlib
+import threading
+import uuid
+import json
+import logging
 from collections import deque
 from discord.ext import commands
 from discord import app_commands
 from discord.ext import commands #discord help command addition
 from dotenv import load_dotenv
-import spotipy  # Spotify integration
-from spotipy.oauth2 import SpotifyClientCredentials # Spotify function authentication declaration
+from search_cache import SearchCache, is_stream_entry, stream_url_expiry
+from ytdl_pool import ExtractorPool
+from spotify_client import AsyncSpotify, RETRY_STATUSES as SPOTIFY_RETRY_STATUSES
+from queue_store import create_queue_store
+from audio_cache import AudioCache
+from shared_source import SourceBroker
+from ffmpeg_profiles import FFmpegProfiles, find_ffmpeg
+from query_classifier import classify, SPOTIFY, YOUTUBE, UNSUPPORTED
+from loop_watchdog import LoopWatchdog
+from admission import Admission, RateLimited
+from track_matcher import best_match
+from botlog import setup_logging
+import metrics
 
 
 # Environment variables for tokens and other sensitive data
 load_dotenv("dc_env/.env")
 TOKEN = os.getenv("DISCORD_TOKEN")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 keeps the metrics endpoint off
 
-# Spotify credentials - Needed for spotify API to access track info
-sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(
-    client_id=os.getenv("SPOTIFY_CLIENT_ID"),
-    client_secret=os.getenv("SPOTIFY_CLIENT_SECRET")
-))
-
-# Create the structure for queueing songs - Dictionary of queues
-SONG_QUEUES = {}
-DISCONNECT_TIMERS = {}
-DISCONNECT_DELAY = 300 
+setup_logging()
+log = logging.getLogger("musicbot")
 
-async def search_ytdlp_async(query, ydl_opts):
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: _extract(query, ydl_opts))
+# Spotify credentials - Needed for spotify API to access track info
+# retries are off so rate limits are backed off on the event loop by AsyncSpotify. 429 is
+# left out of the retried statuses: spotipy then raises it with the response headers,
+# so AsyncSpotify sees Spotify's Retry-After instead of a bare "max retries" error
+def make_spotify_client():
+    import spotipy  # Spotify integration, imported by the first Spotify request
+    from spotipy.oauth2 import SpotifyClientCredentials # Spotify function authentication declaration
+    return spotipy.Spotify(
+        auth_manager=SpotifyClientCredentials(
+            client_id=os.getenv("SPOTIFY_CLIENT_ID"),
+            client_secret=os.getenv("SPOTIFY_CLIENT_SECRET")
+        ),
+        retries=0,
+        status_retries=0,
+        status_forcelist=SPOTIFY_RETRY_STATUSES,
+    )
 
-def _extract(query, ydl_opts):
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        return ydl.extract_info(query, download=False)
+spotify = AsyncSpotify(client_factory=make_spotify_client)
+
+# A queued song; the stream URL is filled in just before it plays
+class Track:
+    __slots__ = ("uid", "video_id", "title", "duration", "query", "url", "expires_at", "acodec")
+
+    def __init__(self, video_id, title, duration=None, query=None, url=None, expires_at=0, uid=None, acodec=None):
+        self.uid = uid or uuid.uuid4().hex  # tells queue entries apart even after a round trip through the store
+        self.video_id = video_id
+        self.title = title
+        self.duration = duration
+        self.query = query
+        self.url = url
+        self.expires_at = expires_at
+        self.acodec = acodec  # codec behind url; "opus" streams are played without re-encoding
+
+    def to_dict(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+# Where the song queues live - an append-only log that survives restarts (QUEUE_STORE=log),
+# memory, or QUEUE_STORE=sqlite to share them between shard processes
+queue_store = create_queue_store(
+    encode=lambda track: json.dumps(track.to_dict()),
+    decode=lambda data: Track.from_dict(json.loads(data)),
+)
+DISCONNECT_DELAY = 300 
+RESTORE_CONCURRENCY = int(os.getenv("RESTORE_CONCURRENCY", "8"))  # voice reconnects at once after a restart
+PLAYLIST_CONCURRENCY = int(os.getenv("PLAYLIST_CONCURRENCY", "4"))  # yt-dlp searches running at once per playlist
+PLAYLIST_WINDOW = max(1, PLAYLIST_CONCURRENCY) * 2  # playlist items read ahead of the queue
+SPOTIFY_CANDIDATES = int(os.getenv("SPOTIFY_CANDIDATES", "5"))  # search results ranked per Spotify track
+SPOTIFY_MARKET = os.getenv("SPOTIFY_MARKET", "US")  # country for artist top tracks
+STREAM_LOOKAHEAD = 2  # upcoming queue entries whose stream URL gets resolved ahead of playback
+WARM_PACKETS = 25  # Opus frames (20ms each) buffered from the next track's FFmpeg before it plays
+
+FFMPEG_EXECUTABLE = find_ffmpeg(os.getenv("FFMPEG_PATH"))
+# FFmpeg options per source: bitrate from the voice channel, Opus copied as is, threads capped
+ffmpeg_profiles = FFmpegProfiles(
+    default_bitrate=int(os.getenv("OPUS_BITRATE", "96")),
+    max_bitrate=int(os.getenv("OPUS_MAX_BITRATE", "128")),
+    threads=int(os.getenv("FFMPEG_THREADS", "1")),
+    passthrough=os.getenv("OPUS_PASSTHROUGH", "1") == "1",
+)
+
+# Opus copies of tracks that have played, so repeats skip the download and the encode
+audio_cache = AudioCache(
+    os.getenv("AUDIO_CACHE_DIR", "cache/audio"),
+    max_bytes=int(os.getenv("AUDIO_CACHE_MAX_MB", "2048")) * 1024 * 1024,
+    ffmpeg=FFMPEG_EXECUTABLE,
+    min_plays=int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "1")),
+)
+
+# Leave out clean/censored/radio edits when picking a search result
+def skip_clean_versions(info, *, incomplete=False):
+    title = info.get('title', '').lower()
+    if any(word in title for word in ['clean', 'censored', 'radio edit']):
+        return f"Skipping clean version: {info.get('title')}"
+    return None
+
+# YouTube DL options, one profile per kind of lookup
+YDL_PROFILES = {
+    # searches only need id/title; the stream URL comes at play time
+    "search": {
+        "format": "bestaudio/best",
+        "noplaylist": True,
+        "quiet": True,
+        "default_search": "ytsearch",
+        "extract_flat": "in_playlist",
+        "match_filter": skip_clean_versions,
+    },
+    # several flat results for a Spotify track, ranked by track_matcher instead of filtered
+    "candidates": {
+        "noplaylist": True,
+        "quiet": True,
+        "default_search": "ytsearch",
+        "extract_flat": True,
+    },
+    # direct YouTube links, don't prepend ytsearch
+    "url": {
+        "format": "bestaudio/best",
+        "noplaylist": True,
+        "quiet": True,
+        "default_search": None,
+    },
+    # playlists are read lazily, one page of flat entries at a time
+    "playlist": {
+        "quiet": True,
+        "noplaylist": False,
+        "extract_flat": "in_playlist",
+        "lazy_playlist": True,
+    },
+    # turning a queued video into a playable stream URL right before it plays;
+    # Opus (webm/251) first so FFmpeg can pass it through
+    "stream": {
+        "format": "bestaudio[acodec=opus]/bestaudio/best",
+        "noplaylist": True,
+        "quiet": True,
+        "default_search": "ytsearch",
+    },
+}
+
+# Extractor instances are reused across lookups and get their own threads
+ytdl_pool = ExtractorPool(YDL_PROFILES, max_workers=int(os.getenv("YTDL_WORKERS", "4")),
+                          paging_workers=int(os.getenv("YTDL_PAGING_WORKERS", "2")))
+
+# Opt-in (LOOP_WATCHDOG=1): measures event loop lag and records what blocked it
+watchdog = LoopWatchdog(
+    threshold=int(os.getenv("LOOP_STALL_MS", "250")) / 1000,
+    executors={"ytdl": ytdl_pool},
+) if os.getenv("LOOP_WATCHDOG") == "1" else None
+
+# Rate limits on yt-dlp lookups (per guild and overall, in lookups per second; 0 turns
+# one off) and a cap on each guild's queue, so one busy guild can't slow the rest down
+admission = Admission(
+    guild_rate=float(os.getenv("GUILD_LOOKUP_RATE", "2")),
+    guild_burst=int(os.getenv("GUILD_LOOKUP_BURST", "20")),
+    global_rate=float(os.getenv("GLOBAL_LOOKUP_RATE", "8")),
+    global_burst=int(os.getenv("GLOBAL_LOOKUP_BURST", "40")),
+    max_queue=int(os.getenv("MAX_QUEUE_LENGTH", "500")),
+)
+LOOKUP_MAX_WAIT = float(os.getenv("LOOKUP_MAX_WAIT", "10"))  # seconds a single /play waits for the rate limit
+
+# Cache of yt-dlp lookups, kept on disk so it survives restarts
+search_cache = SearchCache(
+    os.getenv("SEARCH_CACHE_PATH", "cache/search_cache.sqlite3"),
+    max_entries=int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "5000")),
+)
+
+# `key` caches the result under something other than the query, and `pick` chooses
+# the entry to keep out of several results (the first one otherwise). With guild_id,
+# a cache miss takes a lookup from that guild's rate limit before it is extracted,
+# waiting at most `wait` seconds (RateLimited after that); cache hits cost nothing
+async def search_ytdlp_async(query, profile, need_stream=False, key=None, pick=None, guild_id=None, wait=None):
+    if guild_id is not None:
+        loop = asyncio.get_running_loop()
+        cached = await loop.run_in_executor(None, search_cache.get, key or query, need_stream)
+        if cached is not None:
+            return {"entries": [cached]}
+        if not await admission.acquire(guild_id, timeout=wait):
+            raise RateLimited(guild_id)
+    return await asyncio.wrap_future(
+        ytdl_pool.submit(_extract_cached, query, profile, need_stream, key, pick, guild_id is None))
+
+def _extract_cached(submitted, query, profile, need_stream=False, key=None, pick=None, use_cache=True):
+    cached = search_cache.get(key or query, need_stream) if use_cache else None
+    if cached is not None:
+        return {"entries": [cached]}
+    results = ytdl_pool.extract(query, profile, submitted)
+    if results:
+        entries = results.get("entries") or ([results] if "url" in results else [])
+        entry = pick(entries) if pick else (entries[0] if entries else None)
+        if entry:
+            search_cache.put(key or query, entry)
+        if pick:
+            return {"entries": [entry] if entry else []}
+    return results
+
+# Queue entries only describe the song; the stream URL is filled in just before it plays
+def make_track(entry, query):
+    track = Track(entry.get("id"), entry.get("title", "Untitled"), entry.get("duration"), query)
+    if is_stream_entry(entry):
+        track.url = entry["url"]
+        track.expires_at = entry.get("url_expires_at") or stream_url_expiry(entry["url"])
+        track.acodec = entry.get("acodec")
+    return track
+
+# Resolve the stream URL of a queued track, or refresh it if it has expired
+async def ensure_stream_url(track):
+    if track.url and track.expires_at > time.time():
+        return track.url
+    if track.video_id:
+        source = f"https://www.youtube.com/watch?v={track.video_id}"
+    else:
+        source = track.query
+    try:
+        results = await search_ytdlp_async(source, "stream", need_stream=True)
+    except Exception as e:
+        log.warning("stream_resolve_failed video=%s title=%r error=%s", track.video_id, track.title, e)
+        return None
+    entries = (results or {}).get("entries") or ([results] if results and "url" in results else [])
+    if not entries or not entries[0] or not is_stream_entry(entries[0]):
+        return None
+    entry = entries[0]
+    track.url = entry["url"]
+    track.expires_at = entry.get("url_expires_at") or stream_url_expiry(entry["url"])
+    track.acodec = entry.get("acodec")
+    return track.url
     
 def get_source(audio_url, ffmpeg_options):
-    return discord.FFmpegOpusAudio(
-        audio_url,
-        **ffmpeg_options,
-        executable="bin\\ffmpeg\\ffmpeg.exe"
-    )
+    with metrics.FFMPEG_SPAWN_SECONDS.time():
+        return discord.FFmpegOpusAudio(
+            audio_url,
+            **ffmpeg_options,
+            executable=FFMPEG_EXECUTABLE
+        )
+
+# Guilds playing the same track at about the same time share one FFmpeg
+source_broker = SourceBroker(
+    lambda location, options: get_source(location, options),
+    join_seconds=float(os.getenv("SHARED_JOIN_SECONDS", "30")),
+    buffer_seconds=float(os.getenv("SHARED_BUFFER_SECONDS", "120")),
+)
+
+# Open a track from the audio cache if it's there, otherwise from its (resolved) stream URL
+async def open_track_source(track, bitrate, wrap=None):
+    cached_path = audio_cache.lookup(track.video_id)
+    if cached_path:
+        location, options = cached_path, ffmpeg_profiles.cached()
+    else:
+        location = await ensure_stream_url(track)
+        if not location:
+            return None
+        options = ffmpeg_profiles.stream(bitrate, track.acodec)
+    wrap = wrap or (lambda source: source)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: wrap(source_broker.open(track.video_id or location, location, options)))
+
+# Once a track has finished playing from its stream, keep an encoded copy for next time
+async def cache_track_audio(track):
+    try:
+        if not audio_cache.should_fill(track.video_id):
+            return
+        audio_url = await ensure_stream_url(track)
+        if audio_url:
+            await audio_cache.fill(track.video_id, audio_url, ffmpeg_profiles.cache_args(track.acodec))
+    except Exception as e:
+        log.warning("audio_cache_fill_failed video=%s error=%s", track.video_id, e)
+
+# FFmpeg source that was spawned early and already holds its first Opus frames,
+# so switching to it doesn't wait on FFmpeg startup and the first network read
+class PrefetchedSource(discord.AudioSource):
+    def __init__(self, source):
+        self.source = source
+        self.buffer = deque()
+        self.started = False
+        self.lock = threading.Lock()  # warm() runs on an executor thread, read() on the player thread
+
+    def warm(self, packets):
+        for _ in range(packets):
+            with self.lock:
+                if self.started:
+                    return
+                packet = self.source.read()
+                if not packet:
+                    return
+                self.buffer.append(packet)
+
+    def read(self):
+        with self.lock:
+            self.started = True
+            if self.buffer:
+                return self.buffer.popleft()
+            return self.source.read()
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.buffer.clear()
+        self.source.cleanup()
+
+PLAYERS = {}  # guild id -> GuildPlayer
+
+def get_player(guild, channel=None):
+    guild_id = str(guild.id)
+    player = PLAYERS.get(guild_id)
+    if player is None:
+        player = PLAYERS[guild_id] = GuildPlayer(guild, channel)
+    elif channel is not None:
+        player.channel = channel
+    return player
+
+# Owns one guild's playback. Commands post messages to it and a single task handles
+# them one at a time, so nothing else ever pops the queue or starts a source. Handlers
+# never wait on the network: sources are opened in child tasks that post back "opened"
+class GuildPlayer:
+    def __init__(self, guild, channel=None):
+        self.guild = guild
+        self.guild_id = str(guild.id)
+        self.channel = channel  # where "couldn't load" / "I'm leaving" messages go
+        self.current = None  # Track playing right now
+        self.opening = None  # Track whose source a child task is opening
+        self.open_task = None
+        self.first_audio = {}  # track uid -> when its /play started, for the track about to start
+        self.prepared = None  # (track uid, PrefetchedSource) for the head of the queue
+        self.generation = 0  # bumped for every started source so stale after-callbacks are ignored
+        self.idle_timer = None
+        self.prefetch_task = None
+        self.loaders = set()  # playlist resolutions still adding to this guild's queue
+        self.closed = False
+        self.loop = asyncio.get_running_loop()
+        self.inbox = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    def post(self, kind, *args):
+        "Queue a message for the player task; the returned future resolves once it is handled"
+        future = self.loop.create_future()
+        if self.closed:
+            future.set_result(None)  # the bot left; a new player handles this guild from now on
+        else:
+            self.inbox.put_nowait((kind, args, future))
+        return future
+
+    def enqueue(self, track, requested_at=None):
+        "Queue a track; with requested_at, time to first audio is recorded if this wake starts it"
+        queue_store.append(self.guild_id, track)
+        if requested_at is not None:
+            self.first_audio[track.uid] = requested_at
+        return self.post("wake")
+
+    def start_idle_timer(self, delay=None):
+        "Leave after `delay` seconds (DISCONNECT_DELAY by default) unless something plays first"
+        delay = DISCONNECT_DELAY if delay is None else delay
+        self.cancel_idle_timer()
+        self.idle_timer = asyncio.create_task(self._idle_countdown(delay))
+        queue_store.set_disconnect_deadline(self.guild_id, time.time() + delay)
+
+    def cancel_idle_timer(self):
+        if self.idle_timer:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+            queue_store.set_disconnect_deadline(self.guild_id, None)
+
+    async def _run(self):
+        while not self.closed:
+            kind, args, future = await self.inbox.get()
+            try:
+                result = await getattr(self, f"_on_{kind}")(*args)
+            except Exception:
+                log.exception("player_message_failed guild=%s kind=%s", self.guild_id, kind)
+                result = None
+            if not future.done():
+                future.set_result(result)
+        # Messages posted before the leave was handled get the same answer as ones posted after it
+        while not self.inbox.empty():
+            kind, args, future = self.inbox.get_nowait()
+            if kind == "opened" and args[1] is not None:
+                self.loop.run_in_executor(None, args[1].cleanup)
+            if not future.done():
+                future.set_result(None)
+
+    async def _on_wake(self):
+        voice_client = self.guild.voice_client
+        if (self.current is None and self.opening is None and voice_client
+                and not voice_client.is_playing() and not voice_client.is_paused()):
+            await self._play_next()
+        elif self.prepared is None:
+            self._schedule_prefetch()  # a song was queued behind the current one
+        # Only a track this wake started counts towards time to first audio
+        starting = self.opening.uid if self.opening else None
+        self.first_audio = {uid: at for uid, at in self.first_audio.items() if uid == starting}
+        return self.current or self.opening
+
+    async def _on_finished(self, generation, error, ended_at):
+        if error:
+            log.warning("playback_error guild=%s error=%s", self.guild_id, error)
+        if generation != self.generation:
+            return
+        finished, self.current = self.current, None
+        await self._play_next(ended_at)
+        if finished is not None and not error:
+            # Filled only now, so the copy never competes with the live stream it is made from
+            asyncio.create_task(cache_track_audio(finished))
+
+    async def _on_skip(self):
+        voice_client = self.guild.voice_client
+        head = queue_store.peek(self.guild_id)
+        if not voice_client or not head:
+            return None
+        if self.opening is not None:
+            # Still loading: drop it (its "opened" is ignored) and go straight to the next one
+            self.generation += 1
+            self.opening = None
+            await self._play_next()
+            return head[0]
+        if not voice_client.is_playing():
+            return None
+        # The stopped source's after callback posts "finished", which starts the warmed next song
+        voice_client.stop()
+        return head[0]
+
+    async def _on_clear(self):
+        cleared = queue_store.length(self.guild_id)
+        self._cancel_loaders()
+        queue_store.clear(self.guild_id)
+        self._discard_prepared()
+        return cleared
+
+    async def _on_leave(self):
+        self.closed = True
+        self.generation += 1  # the stopped source mustn't start the next song
+        self.current = self.opening = None
+        self.first_audio.clear()
+        self.cancel_idle_timer()
+        self._cancel_loaders()
+        queue_store.clear(self.guild_id)
+        queue_store.clear_session(self.guild_id)
+        self._discard_prepared()
+        if PLAYERS.get(self.guild_id) is self:
+            del PLAYERS[self.guild_id]
+        voice_client = self.guild.voice_client
+        if voice_client:
+            if voice_client.is_playing() or voice_client.is_paused():
+                voice_client.stop()
+            await voice_client.disconnect()
+        return True
+
+    async def _on_idle(self):
+        voice_client = self.guild.voice_client
+        if self.current is not None or self.opening is not None or queue_store.length(self.guild_id):
+            return
+        if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+            return
+        await self._on_leave()
+        self._notify("**I'm leaving**")
+
+    async def _idle_countdown(self, delay):
+        await asyncio.sleep(delay)
+        # idle_timer stays set, so leaving still clears the stored deadline
+        self.post("idle")
+
+    async def _play_next(self, ended_at=None):
+        voice_client = self.guild.voice_client
+        if not voice_client or not voice_client.is_connected():
+            log.debug("voice_not_connected guild=%s", self.guild_id)
+            return
+        track = queue_store.popleft(self.guild_id)
+        if track is None:
+            log.debug("queue_empty guild=%s disconnect_in=%s", self.guild_id, DISCONNECT_DELAY)
+            self._save_session(None)
+            self.start_idle_timer()
+            return
+        self.cancel_idle_timer()
+        self.generation += 1  # also what "opened" is checked against
+        if self.prepared and self.prepared[0] == track.uid:
+            source, self.prepared = self.prepared[1], None
+            self._start(track, source, self.generation, ended_at)
+            return
+        self._discard_prepared()
+        self.opening = track
+        self.open_task = asyncio.create_task(self._open(track, self.generation, ended_at))
+
+    # Child task: resolving the stream URL and spawning FFmpeg can take seconds
+    async def _open(self, track, generation, ended_at):
+        try:
+            source = await open_track_source(track, self._bitrate())
+        except Exception as e:
+            log.warning("source_open_failed guild=%s video=%s error=%s", self.guild_id, track.video_id, e)
+            source = None
+        if self.closed or generation != self.generation:
+            if source is not None:
+                self.loop.run_in_executor(None, source.cleanup)
+            return
+        self.post("opened", track, source, generation, ended_at)
+
+    async def _on_opened(self, track, source, generation, ended_at):
+        if generation != self.generation:
+            # Skipped or left while it was loading
+            if source is not None:
+                self.loop.run_in_executor(None, source.cleanup)
+            return
+        self.opening = None
+        if source is None:
+            log.warning("track_unplayable guild=%s video=%s title=%r", self.guild_id, track.video_id, track.title)
+            self.first_audio.pop(track.uid, None)
+            self._notify(f"Couldn't load **{track.title}**, skipping it")
+            await self._play_next(ended_at)
+            return
+        self._start(track, source, generation, ended_at)
+
+    def _start(self, track, source, generation, ended_at):
+        voice_client = self.guild.voice_client
+
+        def after_play(error):
+            # Runs on the voice thread
+            try:
+                self.loop.call_soon_threadsafe(self.post, "finished", generation, error, time.perf_counter())
+            except RuntimeError:
+                pass  # loop already closed, bot is shutting down
+
+        try:
+            if not voice_client:
+                raise discord.ClientException("Not connected to voice.")
+            voice_client.play(source, after=after_play)
+        except discord.ClientException as e:
+            log.error("voice_play_failed guild=%s error=%s", self.guild_id, e)
+            self.loop.run_in_executor(None, source.cleanup)
+            self._notify("**Something went wrong - Client Exception**")
+            return
+        self.current = track
+        requested_at = self.first_audio.pop(track.uid, None)
+        if requested_at is not None:
+            metrics.FIRST_AUDIO_SECONDS.observe(time.perf_counter() - requested_at)
+        if ended_at is not None:
+            metrics.TRACK_GAP_SECONDS.observe(time.perf_counter() - ended_at)
+        log.info("track_started guild=%s video=%s title=%r", self.guild_id, track.video_id, track.title)
+        self._save_session(track)
+        self._schedule_prefetch()
+
+    # Messages to the text channel are sent from their own task, not the player's
+    def _notify(self, message):
+        if self.channel:
+            asyncio.create_task(self.channel.send(message))
+
+    def _schedule_prefetch(self):
+        if self.prefetch_task is None or self.prefetch_task.done():
+            self.prefetch_task = asyncio.create_task(self._prefetch())
+
+    # Once a track starts: warm the next source, then resolve the URLs after it
+    async def _prefetch(self):
+        try:
+            head = queue_store.peek(self.guild_id, STREAM_LOOKAHEAD)
+            if head:
+                await self._prepare(head[0])
+            for upcoming in head[1:]:
+                await ensure_stream_url(upcoming)
+        except Exception as e:
+            log.warning("prefetch_failed guild=%s error=%s", self.guild_id, e)
+
+    # Spawn and warm the FFmpeg source for the track at the head of the queue
+    async def _prepare(self, track):
+        if self.prepared and self.prepared[0] == track.uid:
+            return
+        self._discard_prepared()
+        source = await open_track_source(track, self._bitrate(), wrap=PrefetchedSource)
+        if source is None:
+            return
+        # The queue may have been cleared or moved on while FFmpeg was starting
+        head = queue_store.peek(self.guild_id)
+        if self.closed or not head or head[0].uid != track.uid:
+            self.loop.run_in_executor(None, source.cleanup)
+            return
+        self._discard_prepared()
+        self.prepared = (track.uid, source)
+        await self.loop.run_in_executor(None, source.warm, WARM_PACKETS)
+
+    # Record the voice channel and playing track so a restart can resume here
+    def _save_session(self, track):
+        voice_client = self.guild.voice_client
+        if voice_client:
+            queue_store.set_session(self.guild_id, voice_client.channel.id, getattr(self.channel, "id", None), track)
+
+    # Opus bitrate that suits the voice channel the bot is in
+    def _bitrate(self):
+        return ffmpeg_profiles.bitrate_for(getattr(self.guild.voice_client, "channel", None))
+
+    # Kill a warmed source that won't be played (queue cleared, bot left, ...)
+    def _cancel_loaders(self):
+        # Cancelled here, before the queue is cleared, so nothing lands in it afterwards
+        for loader in self.loaders:
+            loader.cancel()
+        self.loaders.clear()
+
+    def _discard_prepared(self):
+        if self.prepared:
+            self.loop.run_in_executor(None, self.prepared[1].cleanup)
+            self.prepared = None
 
 # Setup of intents. Intents are permissions the bot has on the server
 intents = discord.Intents.default()
@@ -70,30 +642,139 @@ class HelpCommand(commands.DefaultHelpCommand):
         await channel.send(help_message)
 
 # Bot setup with custom help command
-bot = commands.Bot(command_prefix="!", intents=intents, help_command=HelpCommand())
+# SHARD_COUNT switches to AutoShardedBot; SHARD_IDS picks the shards this process runs (see supervisor.py)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS", "").split(",") if shard_id.strip()] or None
+if SHARD_COUNT or os.getenv("AUTO_SHARD") == "1":
+    bot = commands.AutoShardedBot(
+        command_prefix="!", intents=intents, help_command=HelpCommand(),
+        shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+    )
+else:
+    bot = commands.Bot(command_prefix="!", intents=intents, help_command=HelpCommand())
+
+
+metrics.VOICE_CLIENTS.read = lambda: len(bot.voice_clients)
+metrics.QUEUED_TRACKS.read = queue_store.total_length
+metrics.SHARED_STREAMS.read = lambda: source_broker.stats()["streams"]
+metrics.SHARED_LISTENERS.read = lambda: source_broker.stats()["listeners"]
+metrics.EXTRACTOR_BUSY.read = lambda: ytdl_pool.saturation()["busy"]
+metrics.EXTRACTOR_QUEUED.read = lambda: ytdl_pool.saturation()["queued"]
+metrics.LOOP_STALLS.read = lambda: watchdog.stall_count if watchdog else 0
+metrics.ADMISSION_WAITING.read = lambda: admission.waiting
+metrics.ADMISSION_REJECTED.read = lambda: admission.rejected
+
+STARTUP_TIMES = {"import": 0.0, "ready": 0.0}  # seconds from STARTED_AT
+metrics.IMPORT_SECONDS.read = lambda: STARTUP_TIMES["import"]
+metrics.READY_SECONDS.read = lambda: STARTUP_TIMES["ready"]
+COMMAND_HASH_PATH = os.getenv("COMMAND_HASH_PATH", "cache/command_tree.hash")
+
+# Fingerprint of the slash command definitions, so an unchanged tree isn't synced again
+def command_tree_hash():
+    # The same payload tree.sync() sends, so permissions, choices and localizations count too
+    definitions = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    definitions.sort(key=lambda definition: (definition.get("type", 1), definition["name"]))
+    return hashlib.sha256(json.dumps(definitions, sort_keys=True, default=str).encode()).hexdigest()
+
+# Sync the command tree with Discord, but only when the definitions changed since the last sync
+async def sync_commands():
+    digest = command_tree_hash()
+    try:
+        with open(COMMAND_HASH_PATH) as hash_file:
+            if hash_file.read().strip() == digest and os.getenv("FORCE_COMMAND_SYNC") != "1":
+                log.info("command_sync_skipped hash=%s", digest[:12])
+                return
+    except FileNotFoundError:
+        pass
+    try:
+        synced = await bot.tree.sync()
+    except Exception as e:
+        log.warning("command_sync_failed error=%s", e)
+        return
+    os.makedirs(os.path.dirname(COMMAND_HASH_PATH) or ".", exist_ok=True)
+    with open(COMMAND_HASH_PATH, "w") as hash_file:
+        hash_file.write(digest)
+    log.info("command_sync_done commands=%s hash=%s", len(synced), digest[:12])
+
+# Runs once before connecting, unlike on_ready which fires again on every reconnect
+@bot.event
+async def setup_hook():
+    if METRICS_PORT:
+        await metrics.start_http_server(METRICS_PORT)
+    if watchdog:
+        watchdog.start()
+    # Commands are global, so with several shard processes only the one running shard 0 syncs them.
+    # It runs in the background so it doesn't hold up connecting to the gateway
+    if SHARD_IDS is None or 0 in SHARD_IDS:
+        asyncio.create_task(sync_commands())
+
+# Rejoin the voice channels that were playing before a restart. Queues come back as they
+# were stored; stream URLs are resolved again only when each track is about to play.
+# A channel the bot was idling in is rejoined until its stored idle deadline runs out
+async def restore_sessions():
+    sessions = [session for session in queue_store.sessions() if bot.get_guild(int(session["guild_id"]))]
+    slots = asyncio.Semaphore(RESTORE_CONCURRENCY)
+
+    async def restore(session):
+        guild_id = session["guild_id"]
+        guild = bot.get_guild(int(guild_id))
+        voice_channel = guild.get_channel(session["voice_channel_id"])
+        idle_for = None  # seconds left on the idle timer, when there is nothing to play
+        if session["current"] is None and not queue_store.length(guild_id):
+            deadline = queue_store.disconnect_deadline(guild_id)
+            idle_for = deadline - time.time() if deadline else 0
+        if voice_channel is None or (idle_for is not None and idle_for <= 0):
+            queue_store.clear_session(guild_id)
+            queue_store.set_disconnect_deadline(guild_id, None)
+            return False
+        text_channel = guild.get_channel(session["text_channel_id"]) if session["text_channel_id"] else None
+        if session["current"] is not None:
+            # The song that was playing starts over
+            queue_store.appendleft(guild_id, session["current"])
+            queue_store.set_session(guild_id, voice_channel.id, session["text_channel_id"])
+        try:
+            async with slots:
+                if guild.voice_client is None:
+                    await voice_channel.connect()
+        except Exception as e:
+            log.warning("session_restore_failed guild=%s error=%s", guild_id, e)
+            return False
+        player = get_player(guild, text_channel)
+        if idle_for is not None:
+            player.start_idle_timer(idle_for)
+        else:
+            await player.post("wake")
+        return True
+
+    started = time.perf_counter()
+    restored = await asyncio.gather(*(restore(session) for session in sessions))
+    if sessions:
+        log.info("sessions_restored restored=%s total=%s seconds=%.2f",
+                 sum(restored), len(sessions), time.perf_counter() - started)
 
+sessions_restored = False  # on_ready fires again on reconnects
 
 # Bot ready-up code
 @bot.event
 async def on_ready():
-    await bot.tree.sync()  # Make sure slash commands sync
-    print(f"{bot.user} is online and ready!")
-
-async def disconnect_after_delay(guild_id, voice_client, channel):
-    await asyncio.sleep(DISCONNECT_DELAY)
-    if guild_id in SONG_QUEUES and not SONG_QUEUES[guild_id]:
-        if voice_client and voice_client.is_connected():
-            await voice_client.disconnect()
-            await channel.send("**I'm leaving**")
-        if guild_id in DISCONNECT_TIMERS:
-            del DISCONNECT_TIMERS[guild_id]
+    global sessions_restored
+    log.info("ready user=%s guilds=%s", bot.user, len(bot.guilds))
+    if not sessions_restored:
+        sessions_restored = True
+        STARTUP_TIMES["ready"] = time.perf_counter() - STARTED_AT
+        log.info("startup import_seconds=%.2f ready_seconds=%.2f", STARTUP_TIMES["import"], STARTUP_TIMES["ready"])
+        await restore_sessions()
+
+# Any command counts as activity, so a pending idle disconnect is called off
+def cancel_disconnect_timer(guild_id):
+    player = PLAYERS.get(guild_id)
+    if player:
+        player.cancel_idle_timer()
 
 @bot.tree.command(name="pause", description="Pause the currently playing song.")
 async def pause(interaction: discord.Interaction):
     guild_id_str = str(interaction.guild_id)
-    if guild_id_str in DISCONNECT_TIMERS:
-        DISCONNECT_TIMERS[guild_id_str].cancel()
-        del DISCONNECT_TIMERS[guild_id_str]
+    cancel_disconnect_timer(guild_id_str)
     voice_client = interaction.guild.voice_client
     if voice_client is None:
         return await interaction.response.send_message("I'm not in voice chat")
@@ -105,9 +786,7 @@ async def pause(interaction: discord.Interaction):
 @bot.tree.command(name="continue", description="Continuing song")
 async def resume(interaction: discord.Interaction):
     guild_id_str = str(interaction.guild_id)
-    if guild_id_str in DISCONNECT_TIMERS:
-        DISCONNECT_TIMERS[guild_id_str].cancel()
-        del DISCONNECT_TIMERS[guild_id_str]
+    cancel_disconnect_timer(guild_id_str)
     voice_client = interaction.guild.voice_client
     if voice_client is None:
         return await interaction.response.send_message("I'm not in a channel")
@@ -120,12 +799,13 @@ async def resume(interaction: discord.Interaction):
 @bot.tree.command(name="clear", description="Clear the song queue.")
 async def clear_queue(interaction: discord.Interaction):
     guild_id_str = str(interaction.guild_id)
-    if guild_id_str in DISCONNECT_TIMERS:
-        DISCONNECT_TIMERS[guild_id_str].cancel()
-        del DISCONNECT_TIMERS[guild_id_str]
-    if guild_id_str in SONG_QUEUES:
-        SONG_QUEUES[guild_id_str].clear()
-        await interaction.response.send_message("Cleared the queue")
+    cancel_disconnect_timer(guild_id_str)
+    player = PLAYERS.get(guild_id_str)
+    if queue_store.length(guild_id_str) or (player and player.loaders):
+        # Deferred first: the player may be busy for a moment and Discord wants an answer within 3s
+        await interaction.response.defer()
+        await get_player(interaction.guild, interaction.channel).post("clear")
+        await interaction.followup.send("Cleared the queue")
     else:
         await interaction.response.send_message("There is nothing in the queue to clear")
 
@@ -137,104 +817,146 @@ async def leave(interaction: discord.Interaction):
     if voice_client is None:
         return await interaction.response.send_message("I'm not in a voice channel")
 
-    try:
-        # First stop any ongoing playback
-        if voice_client.is_playing() or voice_client.is_paused():
-            voice_client.stop()
-
-        # Then disconnect
-        await voice_client.disconnect()
-        await interaction.response.send_message("I'm leaving")
-        guild_id_str = str(interaction.guild_id)
-        if guild_id_str in DISCONNECT_TIMERS:
-            del DISCONNECT_TIMERS[guild_id_str]
-        if guild_id_str in SONG_QUEUES:
-            del SONG_QUEUES[guild_id_str]
-    except Exception as e:
-        print(f"Error disconnecting: {e}")
-        await interaction.response.send_message("I had trouble leaving the channel")
-
-# Check if the input is a YouTube URL
-def is_youtube_url(query):
-    youtube_patterns = [
-        r"https?://(?:www\.)?youtube\.com/watch\?v=[A-Za-z0-9_-]+",
-        r"https?://(?:www\.)?youtu\.be/[A-Za-z0-9_-]+"
-    ]
-    return any(re.match(pattern, query) for pattern in youtube_patterns)
-
-# Check if the input is a Spotify URL
-def is_spotify_url(query):
-    spotify_pattern = r"https?://open\.spotify\.com/(track|playlist)/[A-Za-z0-9]+" #added |playlist support
-    return re.match(spotify_pattern, query)
+    # The player stops playback, drops the queue and disconnects
+    await interaction.response.defer()
+    if await get_player(interaction.guild, interaction.channel).post("leave"):
+        await interaction.followup.send("I'm leaving")
+    else:
+        await interaction.followup.send("I had trouble leaving the channel")
 
-# Fetch song name from Spotify URL
-def get_spotify_track_name(url):
-    try:
-        track_id = url.split("track/")[1].split("?")[0]
-        track_info = sp.track(track_id)
-        return f"{track_info['artists'][0]['name']} - {track_info['name']}"
-    except Exception as e:
-        print(f"Error fetching Spotify track: {e}")
+# Fetch song name from a Spotify track id
+async def get_spotify_track_name(track_id):
+    track_info = await get_spotify_track_info(track_id)
+    if not track_info:
         return None
+    return f"{track_info['artist']} - {track_info['title']}"
     
 # fetch detail of single track
-def get_spotify_track_info(url):
-    "Get detailed track info from Spotify URL"
+async def get_spotify_track_info(track_id):
+    "Get detailed track info for a Spotify track id"
     try:
-        track_id = url.split("track/")[1].split("?")[0]
-        track = sp.track(track_id)
-        return {
-            'title': track['name'],
-            'artist': track['artists'][0]['name'],
-            'is_explicit': track.get('explicit', False)
-        }
+        return await spotify.track(track_id)
     except Exception as e:
-        print(f"Spotify error: {e}")
+        log.warning("spotify_lookup_failed track=%s error=%s", track_id, e)
         return None
     
-#fetch all tracks from a Spotify playlist URL
-def get_spotify_playlist_tracks(url):
-    playlist_id = url.split("playlist/")[1].split("?")[0]
-    results = sp.playlist_items(playlist_id)
-    tracks = []
-    for item in results['items']:
-        track = item['track']
-        tracks.append({
-            'title': track['name'],
-            'artist': track['artists'][0]['name'],
-            'spotify_url': track['external_urls']['spotify']
-        })
-    return tracks
-
-#pull playlist tracks from spotify and add them to the queue while playing 
-async def fetch_spotify_playlist_async(interaction, playlist_url, ydl_options):
-    guild_id = str(interaction.guild_id)
-    if guild_id not in SONG_QUEUES:
-        SONG_QUEUES[guild_id] = deque()
-
-    playlist_tracks = get_spotify_playlist_tracks(playlist_url)
-    voice_client = interaction.guild.voice_client
-
-    for track in playlist_tracks:
-        query = f"{track['artist']} - {track['title']} official audio"
-        results = await search_ytdlp_async(f"ytsearch:{query}", ydl_options)
-        entries = results.get("entries", [])
-        if not entries:
-            await interaction.followup.send(f"En ivra tpt me to: {query}")
-            continue
-
-        first_track = entries[0]
-        audio_url = first_track["url"]
-        title = first_track.get("title", "Untitled")
-
-        SONG_QUEUES[guild_id].append((audio_url, title))
-        print(f"Added '{title}' to queue")
+#iterate the tracks of a Spotify playlist, album or artist (top tracks), a page at a time
+async def iter_spotify_tracks(kind, item_id):
+    if kind == "playlist":
+        async for track_info in spotify.iter_playlist_tracks(item_id):
+            yield track_info
+    elif kind == "album":
+        async for track_info in spotify.iter_album_tracks(item_id):
+            yield track_info
+    else:
+        for track_info in await spotify.artist_top_tracks(item_id, SPOTIFY_MARKET):
+            yield track_info
+
+#find a Spotify track on YouTube: one flat search whose candidates are ranked locally.
+#The chosen video is cached under spotify:track:<id>, so the track isn't searched again
+async def search_spotify_track(track_info, guild_id=None, wait=None):
+    query = f"{track_info['artist']} - {track_info['title']} official audio"
+    key = f"spotify:track:{track_info['id']}" if track_info.get("id") else None
+    results = await search_ytdlp_async(f"ytsearch{SPOTIFY_CANDIDATES}:{query}", "candidates", key=key,
+                                       pick=lambda entries: best_match(entries, track_info),
+                                       guild_id=guild_id, wait=wait)
+    entries = (results or {}).get("entries") or []
+    return query, entries[0] if entries else None
+
+#YouTube playlist entries are already videos; deleted/private ones are skipped quietly
+async def youtube_playlist_entry(entry):
+    if entry.get("title") in ("[Deleted video]", "[Private video]"):
+        return None, None
+    return entry.get("url") or entry.get("id"), entry
+
+#queue the tracks of a playlist as its items arrive from `items` (an async iterator),
+#resolving them on a bounded pool while keeping the playlist's order. Returns (added,
+#stopped); stopped is None, "full" when the queue cap was reached or "cancelled" when
+#/clear or /leave ended it
+async def resolve_playlist_tracks(interaction, items, resolve, requested_at=None):
+    player = get_player(interaction.guild, interaction.channel)
+    semaphore = asyncio.Semaphore(max(1, PLAYLIST_CONCURRENCY))
+    started = time.perf_counter()
+    window = deque()  # resolutions started but not queued yet, in playlist order
+    added = total = 0
+    stopped = None
+
+    async def run(item):
+        async with semaphore:
+            try:
+                return await resolve(item)
+            except Exception as e:
+                log.warning("playlist_search_failed item=%r error=%s", item, e)
+                return None, None
+
+    async def queue_next():
+        nonlocal added, stopped
+        query, entry = await window.popleft()
+        if entry is None:
+            if query:
+                await interaction.followup.send(f"I didn't find anything for: {query}")
+            return
+        if not admission.room(queue_store.length(player.guild_id)):
+            stopped = "full"  # another /play filled it up meanwhile
+            return
+        #the player starts playing as soon as the first track is queued
+        track = make_track(entry, query)
+        player.enqueue(track, requested_at if added == 0 else None)
+        added += 1
+        log.debug("playlist_track_queued guild=%s title=%r", player.guild_id, track.title)
+
+    # Only a window of items is read ahead, so a huge playlist is never held in memory;
+    # the next page is fetched once the window has room
+    async def load():
+        nonlocal total, stopped
+        try:
+            try:
+                async for item in items:
+                    if not admission.room(queue_store.length(player.guild_id) + len(window)):
+                        stopped = "full"
+                        break
+                    total += 1
+                    window.append(asyncio.create_task(run(item)))
+                    while window and (len(window) >= PLAYLIST_WINDOW or window[0].done()):
+                        await queue_next()
+            except Exception as e:
+                log.warning("playlist_read_failed guild=%s after=%s error=%s", player.guild_id, total, e)
+            while window:
+                await queue_next()
+        finally:
+            for task in window:
+                task.cancel()
+            if hasattr(items, "aclose"):
+                await items.aclose()  # stops the page fetches behind the iterator
+
+    # Run as its own task so /clear and /leave can cancel it through the player
+    loader = asyncio.create_task(load())
+    player.loaders.add(loader)
+    loader.add_done_callback(player.loaders.discard)
+    try:
+        await asyncio.wait({loader})
+    finally:
+        loader.cancel()  # no-op once it has finished; stops it if /play itself was cancelled
+    if loader.cancelled():
+        stopped = "cancelled"
+    else:
+        loader.result()
 
-        # Start playing immediately if nothing is playing
-        if not voice_client.is_playing() and not voice_client.is_paused():
-            await play_next_song(voice_client, guild_id, interaction.channel)
+    elapsed = time.perf_counter() - started
+    rate = added / elapsed if elapsed > 0 else 0.0
+    log.info("playlist_resolved guild=%s added=%s total=%s seconds=%.1f tracks_per_sec=%.2f concurrency=%s stopped=%s",
+             player.guild_id, added, total, elapsed, rate, PLAYLIST_CONCURRENCY, stopped)
+    return added, stopped
 
-        await asyncio.sleep(0.5)  # optional small delay
+#what /play answers once a playlist, album or artist has been queued
+def playlist_reply(added, stopped, empty_message):
+    if stopped == "cancelled":
+        return "Stopped loading that playlist"
+    if not added:
+        return f"The queue is full ({admission.max_queue} songs)" if stopped == "full" else empty_message
+    if stopped == "full":
+        return f"added {added} songs to queue, the queue is full ({admission.max_queue} songs)"
+    return f"added {added} songs to queue"
 
 
 
@@ -245,257 +967,147 @@ async def fetch_spotify_playlist_async(interaction, playlist_url, ydl_options):
 @app_commands.describe(song_query="Spotify/YouTube URL or search query")
 
 async def play(interaction: discord.Interaction, song_query: str):
-    print(f"[/play] Command received with query: {song_query}")
+    log.debug("play_received guild=%s query=%r", interaction.guild_id, song_query)
     await interaction.response.defer()
-    print(f"[/play] Interaction deferred.")
+    requested_at = time.perf_counter()
     guild_id_str = str(interaction.guild_id)
-    if guild_id_str in DISCONNECT_TIMERS:
-        print(f"[/play] Cancelling disconnect timer.")
-        DISCONNECT_TIMERS[guild_id_str].cancel()
-        del DISCONNECT_TIMERS[guild_id_str]
+    cancel_disconnect_timer(guild_id_str)
     try:
-        print(f"[/play] Checking voice channel.")
         if not interaction.user.voice:
-            print(f"[/play] User not in a voice channel.")
+            log.debug("play_user_not_in_voice guild=%s", interaction.guild_id)
             return await interaction.followup.send("You will need to be in a channel to play music")
-        print(f"[/play] Handling voice client.")
+        if not admission.room(queue_store.length(guild_id_str)):
+            return await interaction.followup.send(f"The queue is full ({admission.max_queue} songs)")
         voice_client = interaction.guild.voice_client
 
         if not voice_client:
-            print(f"[/play] Connecting to voice channel.")
+            log.debug("voice_connecting guild=%s", interaction.guild_id)
             voice_client = await interaction.user.voice.channel.connect()
-            print(f"[/play] Connected to voice channel.")
         elif voice_client.channel != interaction.user.voice.channel:
-            print(f"[/play] Moving to user's voice channel.")
+            log.debug("voice_moving guild=%s", interaction.guild_id)
             await voice_client.move_to(interaction.user.voice.channel)
-            print(f"[/play] Moved to user's voice channel.")
-
-        # YouTube DL options
-        ydl_options = {
-            "format": "bestaudio/best",
-            "noplaylist": True,
-            "quiet": True,
-            "default_search": "ytsearch",
-            "match_filter": lambda info: not any(
-                word in info.get('title', '').lower()
-                for word in ['clean', 'censored', 'radio edit']
-            ),
-        }
-
-        print(f"[/play] Handling input query.")
-        if is_spotify_url(song_query):
-            if "track/" in song_query:
-                track_info = get_spotify_track_info(song_query)
+
+        parsed = classify(song_query)
+        results = None
+        if parsed.source == SPOTIFY:
+            if parsed.kind == "track":
+                track_info = await get_spotify_track_info(parsed.id)
                 if not track_info:
                     return await interaction.followup.send("Spotify track error get_spotify_track_info(song_query)")
-                query_list = [f"{track_info['artist']} - {track_info['title']} official audio"]
-
-                # Process single track like before
-                for query in query_list:
-                    print(f"[/play] Spotify search query: {query}")
-                    results = await search_ytdlp_async(f"ytsearch:{query}", ydl_options)
-                    tracks = results.get("entries", [])
-                    if not tracks:
-                        print(f"[/play] No tracks found for Spotify query: {query}")
-                        await interaction.followup.send(f"I didn't find anything for: {query}")
-                        continue
-                    first_track = tracks[0]
-                    audio_url = first_track["url"]
-                    title = first_track.get("title", "Untitled")
-                    print(f"[/play] Found track: {title} - URL: {audio_url}")
-
-                    guild_id = str(interaction.guild_id)
-                    if guild_id not in SONG_QUEUES:
-                        SONG_QUEUES[guild_id] = deque()
-                        print(f"[/play] Created new queue for guild {guild_id}.")
-
-                    SONG_QUEUES[guild_id].append((audio_url, title))
-                    print(f"[/play] Added '{title}' to the queue.")
-
-            elif "playlist/" in song_query:
-                #async playlist fetching
-                playlist_tracks = get_spotify_playlist_tracks(song_query)
-                if not playlist_tracks:
-                    return await interaction.followup.send("Spotify playlist error get_spotify_playlist_tracks(song_query)")
-                
-                guild_id = str(interaction.guild_id)
-                if guild_id not in SONG_QUEUES:
-                    SONG_QUEUES[guild_id] = deque()
-
-                for track in playlist_tracks:
-                    query = f"{track['artist']} - {track['title']} official audio"
-                    print(f"[/play] Spotify playlist search query: {query}")
-                    results = await search_ytdlp_async(f"ytsearch:{query}", ydl_options)
-                    tracks = results.get("entries", [])
-                    if not tracks:
-                        await interaction.followup.send(f"I didn't find anything for: {query}")
-                        continue
-
-                    first_track = tracks[0]
-                    audio_url = first_track["url"]
-                    title = first_track.get("title", "Untitled")
-                    SONG_QUEUES[guild_id].append((audio_url, title))
-                    print(f"[/play] Added '{title}' to the queue from playlist.")
-
-                    #start playing immediately if nothing is playing
-                    if not voice_client.is_playing() and not voice_client.is_paused():
-                        await play_next_song(voice_client, guild_id, interaction.channel)
-
-                    await asyncio.sleep(0.3)  #small delay to avoid blocking
-
-                await interaction.followup.send("added playlist to queue")
+                # Falls through to the queueing below with the best ranked match
+                query, entry = await search_spotify_track(track_info, guild_id_str, LOOKUP_MAX_WAIT)
+                log.debug("play_spotify_match query=%r video=%s", query, entry and entry.get("id"))
+                results = {"entries": [entry] if entry else []}
+
+            else:
+                #playlists, albums and artists are queued page by page while the first songs play
+                #each track's search waits its turn on the guild's rate limit (cache hits don't)
+                added, stopped = await resolve_playlist_tracks(
+                    interaction, iter_spotify_tracks(parsed.kind, parsed.id),
+                    lambda track_info: search_spotify_track(track_info, guild_id_str), requested_at)
+                await interaction.followup.send(
+                    playlist_reply(added, stopped, "I couldn't load anything from that Spotify link"))
                 return  #stop further processing
 
-        elif is_youtube_url(song_query):
-            print(f"[/play] Input is a YouTube URL.")
-            query = song_query
-            ydl_options["default_search"] = None  # Don't prepend ytsearch
-        elif song_query.startswith("https://") or song_query.startswith("http://"):
+        elif parsed.source == YOUTUBE and parsed.kind == "playlist":
+            #the entries come with the playlist pages, so they cost no rate-limited lookups
+            added, stopped = await resolve_playlist_tracks(
+                interaction, ytdl_pool.iter_entries(parsed.lookup, "playlist"), youtube_playlist_entry, requested_at)
+            return await interaction.followup.send(
+                playlist_reply(added, stopped, "I couldn't load anything from that playlist"))
+
+        elif parsed.source == YOUTUBE:
+            query = parsed.lookup  # watch URL, whether it came as a youtu.be/shorts/music link or a bare id
+            profile = "url"  # Don't prepend ytsearch
+        elif parsed.source == UNSUPPORTED:
             return await interaction.followup.send("Only Spotify or YouTube links are supported")
         else:
-            query = f"ytsearch:{song_query}"
-            print(f"[/play] YouTube search query: {query}")
+            query = parsed.lookup
+            profile = "search"
+            log.debug("play_youtube_search query=%r", query)
 
         # Handle single YouTube search or URL
-        print(f"[/play] Searching with yt-dlp.")
-        results = await search_ytdlp_async(query, ydl_options)
+        if results is None:
+            results = await search_ytdlp_async(query, profile, guild_id=guild_id_str, wait=LOOKUP_MAX_WAIT)
         tracks = results.get("entries", [])
         if not tracks:
             if "entries" in results and not results["entries"]:
-                print(f"[/play] No tracks found for URL or search.")
+                log.debug("play_no_results query=%r", query)
                 return await interaction.followup.send("I didn't find anything with the link or search")
             elif 'url' in results:
                 tracks = [results]
             else:
-                print(f"[/play] No tracks found.")
+                log.debug("play_no_results query=%r", query)
                 return await interaction.followup.send("I didn't find anything")
 
-        first_track = tracks[0]
-        audio_url = first_track["url"]
-        title = first_track.get("title", "Untitled")
-        print(f"[/play] Found track: {title} - URL: {audio_url}")
-
-        guild_id = str(interaction.guild_id)
-        if guild_id not in SONG_QUEUES:
-            SONG_QUEUES[guild_id] = deque()
-            print(f"[/play] Created new queue for guild {guild_id}.")
+        track = make_track(tracks[0], song_query)
+        title = track.title
 
-        SONG_QUEUES[guild_id].append((audio_url, title))
-        print(f"[/play] Added '{title}' to the queue.")
+        was_playing = voice_client.is_playing() or voice_client.is_paused()
+        await get_player(interaction.guild, interaction.channel).enqueue(track, requested_at)
+        log.debug("play_track_queued guild=%s video=%s title=%r", interaction.guild_id, track.video_id, title)
 
-        if voice_client.is_playing() or voice_client.is_paused():
-            print(f"[/play] Bot is playing music or it's paused. Sending 'added to queue' message.")
+        if was_playing:
             await interaction.followup.send(f"Song:**{title}** Added to queue")
         else:
-            print(f"[/play] Bot is not playing. Calling play_next_song.")
-            await play_next_song(voice_client, guild_id, interaction.channel)
             await interaction.followup.send(f"**Now playing:** `{title}`")
 
-    except Exception as e:
-        print(f"[/play] Error in /play: {e}")
+    except RateLimited:
+        log.info("play_rate_limited guild=%s query=%r", interaction.guild_id, song_query)
+        await interaction.followup.send("Too many songs are being looked up right now, try again in a moment")
+    except Exception:
+        log.exception("play_failed guild=%s query=%r", interaction.guild_id, song_query)
         await interaction.followup.send("Something went wrong while processing your request.")
 
-# Function to handle playing the next song
-async def play_next_song(voice_client, guild_id, channel):
-    print("Inside play_next_song")
-    print(f"play_next_song - voice_client: {voice_client}, connected: {voice_client.is_connected() if voice_client else None}")
-    print(f"play_next_song - SONG_QUEUES.get({guild_id}): {SONG_QUEUES.get(guild_id)}")
-    try:
-        if not voice_client or not voice_client.is_connected():
-            print("play_next_song - Voice client not valid or not connected.")
-            return
-
-        if not SONG_QUEUES.get(guild_id):
-            print("play_next_song - Song queue is empty. Starting disconnect timer.")
-            if guild_id in DISCONNECT_TIMERS:
-                DISCONNECT_TIMERS[guild_id].cancel()
-            DISCONNECT_TIMERS[guild_id] = asyncio.create_task(disconnect_after_delay(guild_id, voice_client, channel))
-            return
-
-        audio_url, title = SONG_QUEUES[guild_id].popleft()
-        print(f"play_next_song - Playing: {title} - URL: {audio_url}")
-        ffmpeg_options = {
-            "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-            "options": "-vn -c:a libopus -b:a 96k",
-        }
-        source = get_source(audio_url, ffmpeg_options)
-
-        def after_play(error):
-            print("Inside after_play")
-            if error:
-                print(f"Playback error in after_play: {error}")
-            try:
-                asyncio.run_coroutine_threadsafe(
-                    play_next_song(voice_client, guild_id, channel),
-                    bot.loop
-                )
-            except Exception as e:
-                print(f"Error in after_play calling play_next_song: {e}")
-
-        # Start playback
-        voice_client.play(source, after=after_play)
-        print(f"play_next_song - Started playing: {title}")
-        # REMOVED THE CHANNEL SEND HERE
-
-    except discord.ClientException as e:
-        print(f"Discord Client Exception in play_next_song: {e}")
-        await channel.send("**Something went wrong - Client Exception**")
-    except Exception as e:
-        print(f"General Error in play_next_song: {e}")
-        await channel.send("**Something went wrong :(**")
-
 @bot.tree.command(name="skip", description="Skips the current playing song")
 async def skip(interaction: discord.Interaction):
     guild_id_str = str(interaction.guild_id)
-    if guild_id_str in DISCONNECT_TIMERS:
-        DISCONNECT_TIMERS[guild_id_str].cancel()
-        del DISCONNECT_TIMERS[guild_id_str]
+    cancel_disconnect_timer(guild_id_str)
     voice_client = interaction.guild.voice_client
 
     if not voice_client or not voice_client.is_connected():
         return await interaction.response.send_message("I'm not in a voice channel")
 
-    if not voice_client.is_playing():
+    player = PLAYERS.get(guild_id_str)
+    if not voice_client.is_playing() and not (player and player.opening):
         return await interaction.response.send_message("There is nothing playing right now")
 
     # Check if queue exists and has songs
-    if not SONG_QUEUES.get(guild_id_str):
+    if not queue_store.length(guild_id_str):
         return await interaction.response.send_message("There is no next song in the queue to skip to")
 
-    # Clean up current player
-    if voice_client.is_playing():
-        voice_client.stop()
-
-    # Small delay to ensure clean transition
-    await asyncio.sleep(0.5)
-
-    # Get next song
-    try:
-        audio_url, title = SONG_QUEUES[guild_id_str].popleft()
-    except IndexError:
-        return await interaction.response.send_message("No more songs in the queue to skip to")
-
-    ffmpeg_options = {
-        "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-        "options": "-vn -c:a libopus -b:a 96k -loglevel warning",
-    }
-
-    try:
-        source = get_source(audio_url, ffmpeg_options)
-
-        def after_play(error):
-            if error:
-                print(f"Error playing {title}: {error}")
-            asyncio.run_coroutine_threadsafe(
-                play_next_song(voice_client, guild_id_str, interaction.channel),
-                bot.loop
-            )
-
-        voice_client.play(source, after=after_play)
-        await interaction.response.send_message(f"Skipping Current song, Playing next: **{title}**")
-    except Exception as e:
-        print(f"Error in skip: {e}")
-        await interaction.response.send_message("Something went wrong while trying to skip the song.")
-
-# Run the bot
-bot.run(TOKEN)
+    await interaction.response.defer()
+    next_track = await get_player(interaction.guild, interaction.channel).post("skip")
+    if next_track is None:
+        return await interaction.followup.send("No more songs in the queue to skip to")
+    await interaction.followup.send(f"Skipping Current song, Playing next: **{next_track.title}**")
+
+# Watchdog report for the bot's owner: event loop lag, recent stalls and where they blocked
+@bot.tree.command(name="health", description="Event loop lag and blocking calls (bot owner only)")
+@app_commands.default_permissions(administrator=True)
+async def health(interaction: discord.Interaction):
+    if not await bot.is_owner(interaction.user):
+        return await interaction.response.send_message("Only the bot's owner can use this", ephemeral=True)
+    if watchdog is None:
+        return await interaction.response.send_message("The watchdog is off, set LOOP_WATCHDOG=1 to turn it on", ephemeral=True)
+    report = watchdog.report()
+    lines = [
+        f"loop lag (last minute): p50 {report['lag_p50'] * 1000:.1f}ms, p99 {report['lag_p99'] * 1000:.1f}ms, "
+        f"max {report['lag_max'] * 1000:.1f}ms",
+        f"stalls over {watchdog.threshold * 1000:.0f}ms: {report['stall_count']}",
+    ]
+    for name, state in report["executors"].items():
+        lines.append(f"{name} executor: {state['busy']} busy, {state['queued']} queued ({state['utilization']:.0%})")
+    for stall in list(reversed(report["stalls"]))[:3]:
+        busy = ", ".join(f"{name} {state['busy']} busy/{state['queued']} queued" for name, state in stall["executors"].items())
+        lines.append(f"\n{time.strftime('%H:%M:%S', time.localtime(stall['at']))} blocked {stall['seconds'] * 1000:.0f}ms"
+                     f"{f' ({busy})' if busy else ''}:")
+        lines.extend(stall["stack"][-4:])
+    text = "\n".join(lines)
+    await interaction.response.send_message(f"```\n{text[-1900:]}\n```", ephemeral=True)
+
+STARTUP_TIMES["import"] = time.perf_counter() - STARTED_AT
+
+# Run the bot (importing the module, e.g. from benchmarks/, doesn't connect)
+if __name__ == "__main__":
+    bot.run(TOKEN, log_handler=None)  # logging is already set up by setup_logging
@@ -0,0 +1,89 @@
+# Admission control for yt-dlp lookups. Each lookup takes a token from its guild's
+# bucket and one from a shared bucket, so a guild queueing huge playlists over and over
+# is held to its own rate instead of slowing /play down for every other guild
+import asyncio
+import time
+
+import metrics
+
+MAX_IDLE_BUCKETS = 1024  # full guild buckets are forgotten once there are more than this
+
+
+class RateLimited(Exception):
+    "A lookup that would have waited longer than it may for the rate limit"
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate    # tokens per second; 0 means unlimited
+        self.burst = burst  # most tokens saved up at once
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, cost=1):
+        "Seconds until `cost` tokens are available, 0 if they are now"
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    def take(self, cost=1):
+        if self.rate > 0:
+            self.tokens -= cost
+
+    def is_full(self):
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class Admission:
+    def __init__(self, guild_rate=2.0, guild_burst=20, global_rate=8.0, global_burst=40, max_queue=500):
+        self.guild_rate = guild_rate
+        self.guild_burst = guild_burst
+        self.shared = TokenBucket(global_rate, global_burst)
+        self.buckets = {}  # guild id -> TokenBucket
+        self.max_queue = max_queue  # tracks per guild queue; 0 means no cap
+        self.waiting = 0
+        self.rejected = 0
+
+    def _bucket(self, guild_id):
+        bucket = self.buckets.get(guild_id)
+        if bucket is None:
+            if len(self.buckets) >= MAX_IDLE_BUCKETS:
+                # A full bucket is the same as a new one, so only guilds that are busy keep theirs
+                for key in [key for key, old in self.buckets.items() if old.is_full()]:
+                    del self.buckets[key]
+            bucket = self.buckets[guild_id] = TokenBucket(self.guild_rate, self.guild_burst)
+        return bucket
+
+    async def acquire(self, guild_id, cost=1, timeout=None):
+        "Wait for `cost` lookups; False (and nothing taken) if that would take over `timeout` seconds"
+        bucket = self._bucket(guild_id)
+        started = time.monotonic()
+        while True:
+            # Checked and taken without awaiting in between, so concurrent waiters can't both win
+            wait = max(bucket.wait_time(cost), self.shared.wait_time(cost))
+            if wait <= 0:
+                bucket.take(cost)
+                self.shared.take(cost)
+                metrics.ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started)
+                return True
+            if timeout is not None and time.monotonic() + wait - started > timeout:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.waiting -= 1
+
+    def room(self, queued):
+        "How many more tracks a guild queue holding `queued` tracks may take"
+        if not self.max_queue:
+            return float("inf")
+        return max(0, self.max_queue - queued)
@@ -0,0 +1,105 @@
+# On-disk cache of already-encoded Opus/Ogg files, keyed by video id. Cached
+# tracks play from the local file with no download and no re-encode
+import asyncio
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger("musicbot.audio_cache")
+
+VIDEO_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{11}$")
+MAX_TRACKED_PLAYS = 5000  # videos whose uncached plays are counted; the least recently played drop out
+
+
+class AudioCache:
+    def __init__(self, directory, max_bytes, ffmpeg="ffmpeg", bitrate="96k", min_plays=1, max_fills=2):
+        self.directory = directory
+        self.max_bytes = max_bytes  # 0 turns filling off; existing files still play
+        self.ffmpeg = ffmpeg
+        self.bitrate = bitrate
+        self.min_plays = min_plays  # plays from the stream before a track is worth caching
+        self.plays = OrderedDict()  # video id -> uncached plays so far, least recently played first
+        self.filling = set()
+        self._fill_slots = asyncio.Semaphore(max_fills)
+        self._evict_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, video_id):
+        return os.path.join(self.directory, f"{video_id}.ogg")
+
+    def lookup(self, video_id):
+        "Path of the cached file for a video, or None; a hit counts as a use for LRU"
+        if not video_id or not VIDEO_ID_PATTERN.match(video_id):
+            return None
+        path = self.path(video_id)
+        try:
+            os.utime(path)  # eviction goes by mtime
+        except OSError:
+            return None
+        return path
+
+    def should_fill(self, video_id):
+        "Count a play from the stream; True once the track has earned a cached copy"
+        if self.max_bytes <= 0 or not video_id or not VIDEO_ID_PATTERN.match(video_id) or video_id in self.filling:
+            return False
+        if os.path.exists(self.path(video_id)):
+            return False
+        self.plays[video_id] = self.plays.get(video_id, 0) + 1
+        self.plays.move_to_end(video_id)
+        while len(self.plays) > MAX_TRACKED_PLAYS:
+            self.plays.popitem(last=False)
+        return self.plays[video_id] >= self.min_plays
+
+    async def fill(self, video_id, audio_url, output_args=None):
+        "Encode a stream to Opus/Ogg in the cache directory (background work, one FFmpeg per fill)"
+        output_args = output_args or ["-vn", "-c:a", "libopus", "-b:a", self.bitrate]
+        if video_id in self.filling:
+            return False
+        self.filling.add(video_id)
+        partial = self.path(video_id) + ".part"
+        try:
+            async with self._fill_slots:
+                process = await asyncio.create_subprocess_exec(
+                    self.ffmpeg, "-nostdin", "-loglevel", "error",
+                    "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5",
+                    "-i", audio_url, *output_args, "-f", "ogg", "-y", partial,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+                )
+                _, stderr = await process.communicate()
+            if process.returncode != 0:
+                log.warning("audio_cache_fill_failed video=%s code=%s error=%s",
+                            video_id, process.returncode, stderr.decode(errors="replace").strip()[:200])
+                return False
+            os.replace(partial, self.path(video_id))
+            self.plays.pop(video_id, None)
+            log.info("audio_cache_filled video=%s bytes=%s", video_id, os.path.getsize(self.path(video_id)))
+            await asyncio.get_running_loop().run_in_executor(None, self.evict)
+            return True
+        except OSError as e:
+            log.warning("audio_cache_fill_failed video=%s error=%s", video_id, e)
+            return False
+        finally:
+            self.filling.discard(video_id)
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def evict(self):
+        "Delete least recently played files until the cache fits in max_bytes"
+        with self._evict_lock:
+            files = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and entry.name.endswith(".ogg"):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    log.debug("audio_cache_evicted path=%s", path)
+                except OSError:
+                    pass
@@ -0,0 +1,70 @@
+# Micro-benchmark of query_classifier.classify against the per-call regex matching
+# and substring checks /play used to do.
+#
+#   python benchmarks/classifier_bench.py --number 100000
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from query_classifier import classify  # noqa: E402
+
+QUERIES = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ?t=42",
+    "https://music.youtube.com/watch?v=dQw4w9WgXcQ&list=RDAMVM",
+    "https://www.youtube.com/shorts/dQw4w9WgXcQ",
+    "https://www.youtube.com/playlist?list=PLFgquLnL59alCl_2TQvOiD5Vgm1hCaGSI",
+    "https://open.spotify.com/track/4cOdK2wGLETKBW3PvgPWqT?si=abc",
+    "https://open.spotify.com/intl-de/album/1ATL5GLyefJaxhQzSPVrLX",
+    "https://open.spotify.com/playlist/37i9dQZF1DXcBWIGoYBM5M",
+    "dQw4w9WgXcQ",
+    "never gonna give you up",
+]
+
+
+def legacy(query):
+    "What /play did before: string patterns matched on every call, then substring parsing"
+    if re.match(r"https?://open\.spotify\.com/(track|playlist)/[A-Za-z0-9]+", query):
+        if "track/" in query:
+            return "spotify", "track", query.split("track/")[1].split("?")[0]
+        return "spotify", "playlist", query.split("playlist/")[1].split("?")[0]
+    youtube_patterns = [
+        r"https?://(?:www\.)?youtube\.com/watch\?v=[A-Za-z0-9_-]+",
+        r"https?://(?:www\.)?youtu\.be/[A-Za-z0-9_-]+",
+    ]
+    if any(re.match(pattern, query) for pattern in youtube_patterns):
+        return "youtube", "video", query
+    return "search", "search", f"ytsearch:{query}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time query classification")
+    parser.add_argument("--number", type=int, default=100000, help="calls per measurement")
+    args = parser.parse_args()
+
+    uncached = classify.__wrapped__
+    candidates = [
+        ("legacy regexes", legacy),
+        ("classify (uncached)", uncached),
+        ("classify (lru hit)", classify),
+    ]
+    print(f"{'':<22}{'ns/query':>10}")
+    for name, func in candidates:
+        def run():
+            for query in QUERIES:
+                func(query)
+        seconds = min(timeit.repeat(run, number=args.number // len(QUERIES), repeat=3))
+        print(f"{name:<22}{seconds / args.number * 1e9:>10.0f}")
+
+    print()
+    for query in QUERIES:
+        parsed = classify(query)
+        print(f"{parsed.source:<8} {parsed.kind:<9} {parsed.cache_key:<45} <- {query}")
+
+
+if __name__ == "__main__":
+    main()
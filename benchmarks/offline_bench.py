@@ -0,0 +1,319 @@
+# Offline benchmark: drives the real /play, /skip, /clear and /leave handlers from
+# MyBot.py against in-process fakes for Discord, yt-dlp and Spotify.
+#
+#   python benchmarks/offline_bench.py --guilds 1 10 100 1000 --search-latency 0.05
+#
+# Reports p50/p99 command latency, playlist enqueue throughput and event-loop lag
+# for each guild count. Nothing touches the network.
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Keep the on-disk caches out of the working tree and the queues in memory
+_tmp = tempfile.mkdtemp(prefix="musicbot-bench-")
+os.environ.setdefault("SEARCH_CACHE_PATH", os.path.join(_tmp, "search_cache.sqlite3"))
+os.environ["QUEUE_STORE"] = "memory"
+os.environ.setdefault("AUDIO_CACHE_DIR", os.path.join(_tmp, "audio"))
+os.environ.setdefault("AUDIO_CACHE_MAX_MB", "0")  # no FFmpeg here, so never fill
+os.environ.setdefault("GUILD_LOOKUP_RATE", "0")  # time the handlers, not the rate limits
+os.environ.setdefault("GLOBAL_LOOKUP_RATE", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import MyBot  # noqa: E402  (needs the environment above)
+
+LAG_INTERVAL = 0.01  # how often the lag probe wakes up
+
+
+# ---- Discord fakes ----
+
+class FakeSource:
+    "Stands in for FFmpegOpusAudio; hands out silent Opus frames"
+    def __init__(self, url):
+        self.url = url
+
+    def read(self):
+        return b"\xf8\xff\xfe"
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        pass
+
+
+class FakeVoiceClient:
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+        self.source = None
+        self.after = None
+        self.paused = False
+        self.connected = True
+
+    def is_connected(self):
+        return self.connected
+
+    def is_playing(self):
+        return self.source is not None and not self.paused
+
+    def is_paused(self):
+        return self.source is not None and self.paused
+
+    def play(self, source, after=None):
+        if self.source is not None:
+            raise MyBot.discord.ClientException("Already playing audio.")
+        self.source = source
+        self.after = after
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def stop(self):
+        source, after = self.source, self.after
+        self.source = self.after = None
+        self.paused = False
+        if source is not None:
+            source.cleanup()
+            if after:
+                after(None)  # discord.py calls this from the player thread; call_soon_threadsafe copes
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self, force=False):
+        self.stop()
+        self.connected = False
+        self.guild.voice_client = None
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild):
+        self.guild = guild
+        self.id = guild.id
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self.guild, self)
+        return self.guild.voice_client
+
+
+class FakeTextChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+        self.voice_channel = FakeVoiceChannel(self)
+        self.text_channel = FakeTextChannel(guild_id)
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def defer(self, **kwargs):
+        self.interaction.responded = True
+
+    async def send_message(self, content=None, **kwargs):
+        self.interaction.responded = True
+        self.interaction.messages.append(content)
+
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        self.interaction.messages.append(content)
+
+
+class FakeMember:
+    def __init__(self, voice_channel):
+        self.voice = type("VoiceState", (), {"channel": voice_channel})()
+
+
+class FakeInteraction:
+    def __init__(self, guild):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = guild.text_channel
+        self.user = FakeMember(guild.voice_channel)
+        self.responded = False
+        self.messages = []
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+
+
+# ---- yt-dlp and Spotify fakes ----
+
+def install_fake_extractor(latency):
+    "Replace search_ytdlp_async with a stub that answers after `latency` seconds"
+    async def search(query, profile, need_stream=False, key=None, pick=None, guild_id=None, wait=None):
+        await asyncio.sleep(latency)
+        video_id = f"{abs(hash(query)) % 10**11:011d}"
+        entry = {"id": video_id, "title": f"Result for {query}", "duration": 200}
+        if profile in ("search", "candidates"):
+            entry.update(_type="url", url=f"https://www.youtube.com/watch?v={video_id}")
+        else:
+            entry["url"] = f"https://rr1.googlevideo.com/videoplayback?id={video_id}&expire={int(time.time()) + 21600}"
+        return {"entries": [entry]}
+
+    MyBot.search_ytdlp_async = search
+
+
+class FakeSpotipy:
+    "Answers the spotipy calls AsyncSpotify makes, after `latency` seconds (runs on its threads)"
+    def __init__(self, latency, playlist_size):
+        self.latency = latency
+        self.playlist_size = playlist_size
+
+    def _track(self, track_id):
+        return {
+            "id": track_id, "name": f"Song {track_id}", "artists": [{"name": "Artist"}],
+            "explicit": False, "duration_ms": 200000, "type": "track",
+            "external_urls": {"spotify": f"https://open.spotify.com/track/{track_id}"},
+        }
+
+    def tracks(self, track_ids):
+        time.sleep(self.latency)
+        return {"tracks": [self._track(track_id) for track_id in track_ids]}
+
+    def playlist_items(self, playlist_id, limit=100, offset=0, additional_types=("track",)):
+        time.sleep(self.latency)
+        end = min(offset + limit, self.playlist_size)
+        items = [{"track": self._track(f"{playlist_id}{i:06d}")} for i in range(offset, end)]
+        return {"items": items, "total": self.playlist_size}
+
+    def album_tracks(self, album_id, limit=50, offset=0):
+        time.sleep(self.latency)
+        end = min(offset + limit, self.playlist_size)
+        return {"items": [self._track(f"{album_id}{i:06d}") for i in range(offset, end)], "total": self.playlist_size}
+
+
+def install_fakes(args, playlist_stats):
+    install_fake_extractor(args.search_latency)
+    MyBot.spotify.client = FakeSpotipy(args.spotify_latency, args.playlist_size)
+    MyBot.get_source = lambda audio_url, ffmpeg_options: FakeSource(audio_url)
+
+    # Wrap the real playlist resolver to record how many tracks it queued and how fast
+    resolve = MyBot.resolve_playlist_tracks
+
+    async def timed_resolve(*args, **kwargs):
+        started = time.perf_counter()
+        added, stopped = await resolve(*args, **kwargs)
+        playlist_stats.append((added, time.perf_counter() - started))
+        return added, stopped
+
+    MyBot.resolve_playlist_tracks = timed_resolve
+
+
+# ---- benchmark ----
+
+def handler(command):
+    "app_commands.Command keeps the coroutine function on .callback"
+    return getattr(command, "callback", command)
+
+
+async def timed(samples, name, coro):
+    started = time.perf_counter()
+    await coro
+    samples.setdefault(name, []).append(time.perf_counter() - started)
+
+
+async def guild_session(guild, args, samples):
+    play, skip, clear, leave = (handler(MyBot.play), handler(MyBot.skip),
+                                handler(MyBot.clear_queue), handler(MyBot.leave))
+    for n in range(args.songs):
+        await timed(samples, "play", play(FakeInteraction(guild), f"guild {guild.id} song {n}"))
+    await timed(samples, "skip", skip(FakeInteraction(guild)))
+
+    url = f"https://open.spotify.com/playlist/bench{guild.id}"
+    await timed(samples, "play_playlist", play(FakeInteraction(guild), url))
+
+    await timed(samples, "clear", clear(FakeInteraction(guild)))
+    await timed(samples, "leave", leave(FakeInteraction(guild)))
+
+
+async def measure_lag(stop, lags):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + LAG_INTERVAL
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+async def run_round(guild_count, args, first_id, playlist_stats):
+    samples, lags = {}, []
+    playlist_stats.clear()
+    stop = asyncio.Event()
+    probe = asyncio.create_task(measure_lag(stop, lags))
+    guilds = [FakeGuild(first_id + i) for i in range(guild_count)]
+    started = time.perf_counter()
+    await asyncio.gather(*(guild_session(guild, args, samples) for guild in guilds))
+    wall = time.perf_counter() - started
+    stop.set()
+    await probe
+    return samples, playlist_stats, lags, wall
+
+
+def report(guild_count, samples, playlist_stats, lags, wall):
+    print(f"\n== {guild_count} guild(s), {wall:.2f}s wall ==")
+    print(f"{'command':<15}{'n':>7}{'p50 ms':>10}{'p99 ms':>10}")
+    for name in ("play", "skip", "play_playlist", "clear", "leave"):
+        values = samples.get(name, [])
+        print(f"{name:<15}{len(values):>7}{percentile(values, 50) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}")
+    queued = sum(count for count, _ in playlist_stats)
+    per_playlist = [count / elapsed for count, elapsed in playlist_stats if elapsed > 0]
+    print(f"playlist enqueue: {queued} tracks, {queued / wall:.1f} tracks/s overall, "
+          f"{statistics.mean(per_playlist) if per_playlist else 0:.1f} tracks/s per playlist")
+    print(f"event-loop lag: p50 {percentile(lags, 50) * 1000:.1f}ms, p99 {percentile(lags, 99) * 1000:.1f}ms, "
+          f"max {max(lags, default=0) * 1000:.1f}ms")
+
+
+async def main(args):
+    playlist_stats = []
+    install_fakes(args, playlist_stats)
+    first_id = 1
+    for guild_count in args.guilds:
+        result = await run_round(guild_count, args, first_id, playlist_stats)
+        report(guild_count, *result)
+        first_id += guild_count
+        # Let leftover prefetch/cleanup tasks finish before the next round
+        await asyncio.sleep(0.1)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the bot's command handlers")
+    parser.add_argument("--guilds", type=int, nargs="+", default=[1, 10, 100, 1000])
+    parser.add_argument("--songs", type=int, default=3, help="single-song /play calls per guild")
+    parser.add_argument("--playlist-size", type=int, default=50)
+    parser.add_argument("--search-latency", type=float, default=0.05, help="seconds per fake yt-dlp lookup")
+    parser.add_argument("--spotify-latency", type=float, default=0.02, help="seconds per fake Spotify request")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
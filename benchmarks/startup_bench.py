@@ -0,0 +1,61 @@
+# Cold-start benchmark: loads MyBot.py in fresh interpreters and reports how long
+# the module takes to load, and whether yt-dlp/spotipy were (wrongly) imported.
+#
+#   python benchmarks/startup_bench.py --runs 5 --max-seconds 1.5
+#
+# Exits with status 1 when the median load time is over --max-seconds, so a deploy
+# can gate on it. Time to ready needs Discord; the running bot logs it
+# (event=startup ... ready_seconds=) and serves it as musicbot_time_to_ready_seconds.
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import MyBot
+print(json.dumps({
+    "seconds": time.perf_counter() - started,
+    "module_seconds": MyBot.STARTUP_TIMES["import"],
+    "lazy": {name: name not in sys.modules for name in ("yt_dlp", "spotipy")},
+}))
+"""
+
+
+def run_once(env):
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long MyBot.py takes to load")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=None, help="fail if the median is slower")
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="musicbot-startup-")
+    env = dict(os.environ, LOG_LEVEL="WARNING", QUEUE_STORE="memory",
+               SEARCH_CACHE_PATH=os.path.join(tmp, "search_cache.sqlite3"),
+               AUDIO_CACHE_DIR=os.path.join(tmp, "audio"))
+    results = [run_once(env) for _ in range(args.runs)]
+    seconds = [result["seconds"] for result in results]
+    median = statistics.median(seconds)
+    print(f"import MyBot: median {median * 1000:.0f}ms, min {min(seconds) * 1000:.0f}ms, "
+          f"max {max(seconds) * 1000:.0f}ms over {args.runs} runs")
+    for name, lazy in results[-1]["lazy"].items():
+        print(f"{name}: {'not imported' if lazy else 'IMPORTED at startup'}")
+    if args.max_seconds is not None and median > args.max_seconds:
+        print(f"FAIL: median {median:.2f}s is over {args.max_seconds:.2f}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+# Leveled key=value logging. Repeats of the same message are rate limited so a
+# busy guild (or an error loop) can't flood stdout
+import logging
+import os
+import threading
+import time
+
+FORMAT = "%(asctime)s level=%(levelname)s logger=%(name)s event=%(message)s"
+MAX_WINDOWS = 10000  # expired windows are dropped once there are more than this
+
+
+def record_guild(record):
+    "The value logged as guild=%s, so each guild gets its own allowance"
+    template = record.msg if isinstance(record.msg, str) else ""
+    at = template.find("guild=%")
+    if at < 0 or not isinstance(record.args, tuple):
+        return None
+    index = template.count("%", 0, at) - 2 * template.count("%%", 0, at)
+    return record.args[index] if index < len(record.args) else None
+
+
+class RateLimitFilter(logging.Filter):
+    "Let at most `burst` records per (logger, level, message template, guild) through every `interval` seconds"
+    def __init__(self, interval=10.0, burst=5):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}  # (logger, level, template, guild) -> [window start, emitted, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg, record_guild(record))
+        now = time.monotonic()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None and len(self._windows) >= MAX_WINDOWS:
+                self._windows = {k: w for k, w in self._windows.items() if now - w[0] < self.interval}
+            if window is None or now - window[0] >= self.interval:
+                suppressed = window[2] if window else 0
+                self._windows[key] = [now, 1, 0]
+                if suppressed:
+                    record.msg = f"{record.msg} suppressed={suppressed}"
+                return True
+            if window[1] < self.burst:
+                window[1] += 1
+                return True
+            window[2] += 1
+            return False
+
+
+def setup_logging(level=None):
+    level = (level or os.getenv("LOG_LEVEL", "INFO")).upper()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(FORMAT))
+    handler.addFilter(RateLimitFilter(
+        interval=float(os.getenv("LOG_RATE_INTERVAL", "10")),
+        burst=int(os.getenv("LOG_RATE_BURST", "5")),
+    ))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # discord.py is chatty at INFO about gateway details
+    logging.getLogger("discord").setLevel(max(logging.getLevelName(level), logging.WARNING))
+    return handler
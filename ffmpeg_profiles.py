@@ -0,0 +1,49 @@
+# Which FFmpeg to run and with what options. The Opus bitrate follows the voice
+# channel's bitrate, Opus sources are copied instead of re-encoded, and every
+# process gets a thread cap so one host can carry more guilds
+import os
+import shutil
+
+LEGACY_FFMPEG = os.path.join("bin", "ffmpeg", "ffmpeg.exe")  # where the Windows setup keeps it
+RECONNECT_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+
+def find_ffmpeg(configured=None):
+    "FFMPEG_PATH if set, else ffmpeg on PATH, else the bundled Windows build"
+    if configured:
+        return configured
+    return shutil.which("ffmpeg") or (LEGACY_FFMPEG if os.path.exists(LEGACY_FFMPEG) else "ffmpeg")
+
+
+class FFmpegProfiles:
+    def __init__(self, default_bitrate=96, max_bitrate=128, threads=1, passthrough=True):
+        self.default_bitrate = default_bitrate  # kbps when the channel's bitrate is unknown
+        self.max_bitrate = max_bitrate          # kbps; boosted channels go up to 384 but music rarely gains past this
+        self.threads = threads
+        self.passthrough = passthrough
+
+    def bitrate_for(self, channel):
+        "Opus bitrate (kbps) for a voice channel, from its bitrate in bps"
+        bitrate = getattr(channel, "bitrate", None)
+        if not bitrate:
+            return self.default_bitrate
+        return max(8, min(bitrate // 1000, self.max_bitrate))
+
+    def stream(self, bitrate, acodec=None):
+        "FFmpegOpusAudio options for a remote stream"
+        options = {"before_options": RECONNECT_OPTIONS, "options": f"-vn -threads {self.threads}"}
+        if self.passthrough and acodec == "opus":
+            options["codec"] = "opus"  # webm/251 is already Opus: remux, don't encode
+        else:
+            options["bitrate"] = bitrate
+        return options
+
+    def cached(self):
+        "Options for a file from the audio cache, which is always Opus"
+        return {"codec": "opus", "options": f"-vn -threads {self.threads}"}
+
+    def cache_args(self, acodec=None):
+        "FFmpeg output arguments for filling the audio cache"
+        if self.passthrough and acodec == "opus":
+            return ["-vn", "-c:a", "copy", "-threads", str(self.threads)]
+        return ["-vn", "-c:a", "libopus", "-b:a", f"{self.default_bitrate}k", "-threads", str(self.threads)]
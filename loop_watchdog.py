@@ -0,0 +1,97 @@
+# Opt-in event loop health check. A timer on the loop measures how late it wakes up;
+# a watcher thread notices when that timer stops ticking and grabs the loop thread's
+# stack right then, which shows the blocking call that is holding everything up
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+import metrics
+
+log = logging.getLogger("musicbot.watchdog")
+
+STACK_FRAMES = 12  # innermost frames kept per stall
+
+
+class LoopWatchdog:
+    def __init__(self, threshold=0.25, interval=0.05, keep=20, executors=None):
+        self.threshold = threshold  # seconds the loop may be blocked before it counts as a stall
+        self.interval = interval
+        self.executors = executors or {}  # name -> object with saturation(), reported alongside
+        self.lags = deque(maxlen=int(60 / interval))  # about the last minute of lag samples
+        self.stalls = deque(maxlen=keep)  # most recent stalls: {"at", "seconds", "stack", "executors"}
+        self.stall_count = 0
+        self.last_tick = time.monotonic()
+        self._loop_thread_id = None
+        self._stop = threading.Event()
+        self._task = None
+
+    def start(self):
+        "Call from the event loop's thread"
+        self._loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self._task = asyncio.get_running_loop().create_task(self._tick())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        log.info("watchdog_started threshold=%s interval=%s", self.threshold, self.interval)
+
+    def stop(self):
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+
+    def report(self):
+        "Lag percentiles over the last minute, recent stalls and executor saturation"
+        lags = sorted(self.lags)
+
+        def pct(p):
+            return lags[min(len(lags) - 1, int(p / 100 * len(lags)))] if lags else 0.0
+
+        return {
+            "lag_p50": pct(50), "lag_p99": pct(99), "lag_max": lags[-1] if lags else 0.0,
+            "stall_count": self.stall_count,
+            "stalls": list(self.stalls),
+            "executors": {name: executor.saturation() for name, executor in self.executors.items()},
+        }
+
+    async def _tick(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.last_tick = time.monotonic()
+            self.lags.append(lag)
+            metrics.LOOP_LAG_SECONDS.observe(lag)
+
+    def _watch(self):
+        stall = None
+        while not self._stop.wait(self.interval):
+            behind = time.monotonic() - self.last_tick - self.interval
+            if behind > self.threshold:
+                if stall is None:
+                    # Still blocked, so the loop thread's stack is the culprit; the executors are
+                    # read now too, since a job finishing later could be what unblocks the loop
+                    frame = sys._current_frames().get(self._loop_thread_id)
+                    stack = traceback.format_stack(frame)[-STACK_FRAMES:] if frame else []
+                    stall = {
+                        "at": time.time(), "seconds": behind, "stack": [line.strip() for line in stack],
+                        "executors": {name: executor.saturation() for name, executor in self.executors.items()},
+                    }
+                else:
+                    stall["seconds"] = behind
+            elif stall is not None:
+                self._record(stall)
+                stall = None
+
+    def _record(self, stall):
+        self.stall_count += 1
+        self.stalls.append(stall)
+        where = " | ".join(line.splitlines()[0] for line in stall["stack"][-4:])
+        executors = ",".join(
+            f"{name}:{state['busy']}+{state['queued']}" for name, state in stall["executors"].items()
+        )
+        log.warning("loop_stall seconds=%.3f executors=%s where=%s", stall["seconds"], executors or "-", where)
+        log.debug("loop_stall_stack seconds=%.3f stack=%r", stall["seconds"], stall["stack"])
@@ -0,0 +1,143 @@
+# Latency histograms and gauges, served in Prometheus text format on a local port
+import asyncio
+import bisect
+import logging
+import threading
+import time
+
+log = logging.getLogger("musicbot.metrics")
+
+# Seconds; covers everything from a cache hit to a slow extraction
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REGISTRY = []
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()  # observed from executor and voice threads too
+        REGISTRY.append(self)
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.total += value
+            self.count += 1
+
+    def time(self):
+        "Context manager that observes how long its block took"
+        return _Timer(self)
+
+    def render(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.total, self.count
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f"{self.name}_sum {total}")
+        lines.append(f"{self.name}_count {count}")
+        return lines
+
+
+class Gauge:
+    "A value read when the endpoint is scraped"
+    def __init__(self, name, help_text, read=None):
+        self.name = name
+        self.help_text = help_text
+        self.read = read or (lambda: 0)
+        REGISTRY.append(self)
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            log.warning("gauge_read_failed name=%s error=%s", self.name, e)
+            value = float("nan")
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+FIRST_AUDIO_SECONDS = Histogram(
+    "musicbot_first_audio_seconds", "Time from deferring /play to the first track starting")
+EXTRACT_SECONDS = Histogram(
+    "musicbot_ytdl_extract_seconds", "Time spent in yt-dlp extract_info")
+EXTRACT_WAIT_SECONDS = Histogram(
+    "musicbot_ytdl_queue_wait_seconds", "Time extractions wait for a free yt-dlp worker")
+SPOTIFY_SECONDS = Histogram(
+    "musicbot_spotify_request_seconds", "Spotify API request latency")
+FFMPEG_SPAWN_SECONDS = Histogram(
+    "musicbot_ffmpeg_spawn_seconds", "Time to start an FFmpeg source")
+TRACK_GAP_SECONDS = Histogram(
+    "musicbot_track_gap_seconds", "Silence between one track ending and the next starting")
+LOOP_LAG_SECONDS = Histogram(
+    "musicbot_loop_lag_seconds", "How late the event loop woke the watchdog's timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+ADMISSION_WAIT_SECONDS = Histogram(
+    "musicbot_admission_wait_seconds", "Time lookups wait for their guild's and the global rate limit")
+VOICE_CLIENTS = Gauge("musicbot_voice_clients", "Connected voice clients")
+QUEUED_TRACKS = Gauge("musicbot_queued_tracks", "Tracks waiting in all guild queues")
+SHARED_STREAMS = Gauge("musicbot_shared_streams", "FFmpeg processes feeding shared playback")
+SHARED_LISTENERS = Gauge("musicbot_shared_listeners", "Guild sources reading from shared FFmpeg processes")
+IMPORT_SECONDS = Gauge("musicbot_import_seconds", "Time spent loading the bot module at startup")
+READY_SECONDS = Gauge("musicbot_time_to_ready_seconds", "Time from starting to load the bot module to the first on_ready")
+LOOP_STALLS = Gauge("musicbot_loop_stalls", "Event loop stalls over the watchdog threshold since start")
+EXTRACTOR_BUSY = Gauge("musicbot_ytdl_busy_workers", "yt-dlp workers running a job")
+EXTRACTOR_QUEUED = Gauge("musicbot_ytdl_queued_jobs", "yt-dlp jobs waiting for a free worker")
+ADMISSION_WAITING = Gauge("musicbot_admission_waiting", "Lookups waiting on a rate limit right now")
+ADMISSION_REJECTED = Gauge("musicbot_admission_rejected", "/play requests turned away by the rate limit since start")
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+async def _handle(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Skip the headers; every path gets the metrics
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        if request_line.startswith(b"GET"):
+            body = render().encode()
+            status = "200 OK"
+        else:
+            body = b"Method not allowed\n"
+            status = "405 Method Not Allowed"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server(port, host="127.0.0.1"):
+    server = await asyncio.start_server(_handle, host, port)
+    log.info("metrics_listening host=%s port=%s", host, port)
+    return server
@@ -0,0 +1,85 @@
+# Parses a /play query once into what it points at: which service, what kind of
+# item, its id, and the key caches store it under. Patterns are compiled once here
+# instead of being re-evaluated by every caller
+import re
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+YOUTUBE = "youtube"
+SPOTIFY = "spotify"
+SEARCH = "search"
+UNSUPPORTED = "unsupported"
+
+YOUTUBE_VIDEO_PATTERN = re.compile(
+    r"(?:https?://)?(?:www\.|m\.|music\.)?"
+    r"(?:youtube\.com/(?:watch\?(?:[^#]*&)?v=|shorts/|embed/|live/)|youtu\.be/)"
+    r"([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])"
+)
+YOUTUBE_PLAYLIST_PATTERN = re.compile(
+    r"(?:https?://)?(?:www\.|m\.|music\.)?youtube\.com/playlist\?(?:[^#]*&)?list=([A-Za-z0-9_-]+)"
+)
+SPOTIFY_PATTERN = re.compile(
+    r"(?:https?://open\.spotify\.com/(?:intl-[a-z-]+/)?(track|album|playlist|artist)/"
+    r"|spotify:(track|album|playlist|artist):)([A-Za-z0-9]+)"
+)
+SEARCH_PREFIX_PATTERN = re.compile(r"ytsearch(\d*):", re.IGNORECASE)
+VIDEO_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{11}")
+URL_PATTERN = re.compile(r"[a-z][a-z0-9+.-]*://", re.IGNORECASE)
+
+
+class Query(NamedTuple):
+    source: str            # youtube, spotify, search or unsupported
+    kind: str              # video, playlist, track, album, artist or search
+    id: Optional[str]      # video/playlist/Spotify id; the search text for searches
+    cache_key: str         # the same item always gets the same key, whatever the link looked like
+    lookup: Optional[str]  # what to hand yt-dlp (canonical URL or ytsearch query); None for Spotify
+
+    @property
+    def is_collection(self):
+        return self.kind in ("playlist", "album", "artist")
+
+
+def _is_bare_video_id(text):
+    # 11 id characters with a digit and an upper-case letter; plain words don't look like that
+    return (VIDEO_ID_PATTERN.fullmatch(text) is not None
+            and any(c.isdigit() for c in text) and any(c.isupper() for c in text))
+
+
+def youtube_video(video_id):
+    return Query(YOUTUBE, "video", video_id, f"youtube:video:{video_id}",
+                 f"https://www.youtube.com/watch?v={video_id}")
+
+
+def search(text, results=1):
+    text = " ".join(text.strip().lower().split())
+    prefix = "ytsearch:" if results == 1 else f"ytsearch{results}:"
+    return Query(SEARCH, SEARCH, text, prefix + text, prefix + text)
+
+
+@lru_cache(maxsize=4096)
+def classify(query):
+    "Work out what a /play query (URL, Spotify URI, video id, ytsearch: query or text) refers to"
+    text = query.strip()
+    # Substring checks are cheap, so plain searches skip the URL patterns entirely
+    if "youtu" in text:
+        match = YOUTUBE_VIDEO_PATTERN.match(text)
+        if match:
+            return youtube_video(match.group(1))
+        match = YOUTUBE_PLAYLIST_PATTERN.match(text)
+        if match:
+            playlist_id = match.group(1)
+            return Query(YOUTUBE, "playlist", playlist_id, f"youtube:playlist:{playlist_id}",
+                         f"https://www.youtube.com/playlist?list={playlist_id}")
+    elif "spotify" in text:
+        match = SPOTIFY_PATTERN.match(text)
+        if match:
+            kind = match.group(1) or match.group(2)
+            return Query(SPOTIFY, kind, match.group(3), f"spotify:{kind}:{match.group(3)}", None)
+    if len(text) == 11 and _is_bare_video_id(text):
+        return youtube_video(text)
+    match = SEARCH_PREFIX_PATTERN.match(text)
+    if match:
+        return search(text[match.end():], int(match.group(1) or 1))
+    if URL_PATTERN.match(text):
+        return Query(UNSUPPORTED, "url", None, text, None)
+    return search(text)
@@ -0,0 +1,403 @@
+# Where guild queues, disconnect deadlines and voice sessions live. The log store
+# is the default and survives restarts; the SQLite store lets several shard
+# processes share one state file
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+log = logging.getLogger("musicbot.queue_store")
+
+# Store calls run on the event loop, so waiting on another shard process's write lock
+# is kept short: SQLite waits BUSY_TIMEOUT, then a few retries with brief pauses
+BUSY_TIMEOUT = 0.02   # seconds
+BUSY_RETRIES = 4      # worst case is about 0.2s of waiting before the call fails
+
+
+class MemoryQueueStore:
+    def __init__(self):
+        self._queues = {}     # guild id -> deque of tracks
+        self._deadlines = {}  # guild id -> time the bot leaves if still idle
+        self._sessions = {}   # guild id -> voice session to restore after a restart
+
+    def append(self, guild_id, track):
+        self._queues.setdefault(guild_id, deque()).append(track)
+
+    def appendleft(self, guild_id, track):
+        self._queues.setdefault(guild_id, deque()).appendleft(track)
+
+    def popleft(self, guild_id):
+        queue = self._queues.get(guild_id)
+        return queue.popleft() if queue else None
+
+    def peek(self, guild_id, count=1):
+        queue = self._queues.get(guild_id)
+        if not queue:
+            return []
+        return [queue[i] for i in range(min(count, len(queue)))]
+
+    def length(self, guild_id):
+        return len(self._queues.get(guild_id, ()))
+
+    def clear(self, guild_id):
+        self._queues.pop(guild_id, None)
+
+    def guilds(self):
+        return [guild_id for guild_id, queue in self._queues.items() if queue]
+
+    def total_length(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def set_disconnect_deadline(self, guild_id, deadline):
+        if deadline is None:
+            self._deadlines.pop(guild_id, None)
+        else:
+            self._deadlines[guild_id] = deadline
+
+    def disconnect_deadline(self, guild_id):
+        return self._deadlines.get(guild_id)
+
+    def set_session(self, guild_id, voice_channel_id, text_channel_id=None, current=None):
+        "Remember where a guild is playing and what, so a restart can pick it up again"
+        self._sessions[guild_id] = {
+            "guild_id": guild_id, "voice_channel_id": voice_channel_id,
+            "text_channel_id": text_channel_id, "current": current,
+        }
+
+    def clear_session(self, guild_id):
+        self._sessions.pop(guild_id, None)
+
+    def sessions(self):
+        return [dict(session) for session in self._sessions.values()]
+
+
+class LogQueueStore(MemoryQueueStore):
+    """Memory store that journals every change to an append-only file.
+
+    Queues hold the encoded entries and only decode them when they are popped or
+    peeked, so replaying a big log at startup doesn't rebuild every track.
+    """
+    def __init__(self, path, encode=json.dumps, decode=json.loads, compact_every=1000):
+        super().__init__()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.encode = encode
+        self.decode = decode
+        self.compact_every = compact_every  # journal lines written before the file is rewritten
+        self._lock = threading.Lock()
+        self._file = None
+        self._written = 0    # lines in the journal file
+        self._compacted = 0  # lines the last compaction wrote, i.e. the size of the live state
+        self._tail = None    # lines written while a compaction runs, None when none does
+        self._replay()
+        self._compact()
+
+    def append(self, guild_id, track):
+        data = self.encode(track)
+        super().append(guild_id, data)
+        self._write("append", guild_id, data)
+
+    def appendleft(self, guild_id, track):
+        data = self.encode(track)
+        super().appendleft(guild_id, data)
+        self._write("appendleft", guild_id, data)
+
+    def popleft(self, guild_id):
+        data = super().popleft(guild_id)
+        if data is None:
+            return None
+        self._write("popleft", guild_id)
+        return self.decode(data)
+
+    def peek(self, guild_id, count=1):
+        return [self.decode(data) for data in super().peek(guild_id, count)]
+
+    def clear(self, guild_id):
+        if guild_id in self._queues:
+            super().clear(guild_id)
+            self._write("clear", guild_id)
+
+    def set_disconnect_deadline(self, guild_id, deadline):
+        super().set_disconnect_deadline(guild_id, deadline)
+        self._write("deadline", guild_id, deadline)
+
+    def set_session(self, guild_id, voice_channel_id, text_channel_id=None, current=None):
+        current = self.encode(current) if current is not None else None
+        super().set_session(guild_id, voice_channel_id, text_channel_id, current)
+        self._write("session", guild_id, [voice_channel_id, text_channel_id, current])
+
+    def clear_session(self, guild_id):
+        if guild_id in self._sessions:
+            super().clear_session(guild_id)
+            self._write("clear_session", guild_id)
+
+    def sessions(self):
+        sessions = super().sessions()
+        for session in sessions:
+            if session["current"] is not None:
+                session["current"] = self.decode(session["current"])
+        return sessions
+
+    def _write(self, op, guild_id, value=None):
+        line = json.dumps([op, guild_id, value]) + "\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()  # in the OS once written, so a crash of the bot loses nothing
+            self._written += 1
+            if self._tail is not None:
+                self._tail.append(line)  # the running compaction adds it after its snapshot
+            # Queues, deadlines and sessions all take lines, so compare with what compaction writes
+            elif self._written >= self.compact_every and self._written > 2 * self._compacted:
+                # Only the snapshot is taken here; writing and syncing a big journal would stall the loop
+                self._tail = []
+                threading.Thread(target=self._compact_in_background, args=(self._snapshot_locked(),),
+                                 name="queue-log-compact", daemon=True).start()
+
+    def _replay(self):
+        replayed = 0
+        try:
+            with open(self.path, encoding="utf-8") as journal:
+                for line in journal:
+                    try:
+                        op, guild_id, value = json.loads(line)
+                    except ValueError:
+                        log.warning("queue_log_bad_line path=%s line=%s", self.path, replayed + 1)
+                        continue  # most likely the last line, cut short by a crash
+                    self._apply(op, guild_id, value)
+                    replayed += 1
+        except FileNotFoundError:
+            return
+        log.info("queue_log_replayed path=%s ops=%s guilds=%s tracks=%s sessions=%s",
+                 self.path, replayed, len(self.guilds()), self.total_length(), len(self._sessions))
+
+    def _apply(self, op, guild_id, value):
+        if op == "append":
+            MemoryQueueStore.append(self, guild_id, value)
+        elif op == "appendleft":
+            MemoryQueueStore.appendleft(self, guild_id, value)
+        elif op == "popleft":
+            MemoryQueueStore.popleft(self, guild_id)
+        elif op == "clear":
+            MemoryQueueStore.clear(self, guild_id)
+        elif op == "deadline":
+            MemoryQueueStore.set_disconnect_deadline(self, guild_id, value)
+        elif op == "session":
+            MemoryQueueStore.set_session(self, guild_id, *value)
+        elif op == "clear_session":
+            MemoryQueueStore.clear_session(self, guild_id)
+
+    def _compact(self):
+        with self._lock:
+            ops = self._snapshot_locked()
+            self._tail = []
+        self._rewrite(ops)
+
+    def _compact_in_background(self, ops):
+        try:
+            self._rewrite(ops)
+        except OSError:
+            log.exception("queue_log_compact_failed path=%s", self.path)
+            with self._lock:
+                self._tail = None
+                self._compacted = self._written  # try again once the journal has doubled
+
+    def _snapshot_locked(self):
+        "The shortest list of ops that rebuilds the current state"
+        ops = [("append", guild_id, data) for guild_id, queue in self._queues.items() for data in queue]
+        ops.extend(("deadline", guild_id, deadline) for guild_id, deadline in self._deadlines.items())
+        for guild_id, session in self._sessions.items():
+            value = [session["voice_channel_id"], session["text_channel_id"], session["current"]]
+            ops.append(("session", guild_id, value))
+        return ops
+
+    def _rewrite(self, ops):
+        # Write the snapshot without the lock, then add whatever was journaled meanwhile and swap
+        # files. Ops after the snapshot replay on top of it the same way they applied in memory
+        partial = self.path + ".tmp"
+        journal = open(partial, "w", encoding="utf-8")
+        try:
+            for op in ops:
+                journal.write(json.dumps(op) + "\n")
+            journal.flush()
+            os.fsync(journal.fileno())
+            with self._lock:
+                journal.writelines(self._tail)
+                journal.flush()
+                os.replace(partial, self.path)
+                if self._file:
+                    self._file.close()
+                self._file = journal  # already at the end of the new journal
+                self._written = self._compacted = len(ops) + len(self._tail)
+                self._tail = None
+        except BaseException:
+            journal.close()
+            raise
+
+
+class SQLiteQueueStore:
+    def __init__(self, path, encode=json.dumps, decode=json.loads):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.encode = encode
+        self.decode = decode
+        self._lock = threading.Lock()
+        # isolation_level=None so BEGIN IMMEDIATE below controls the transactions
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=BUSY_TIMEOUT)
+        self._db.execute("PRAGMA journal_mode=WAL")  # shard processes read while another writes
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS queue (
+                guild_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (guild_id, position)
+            );
+            CREATE TABLE IF NOT EXISTS disconnect_deadlines (
+                guild_id TEXT PRIMARY KEY,
+                deadline REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS sessions (
+                guild_id TEXT PRIMARY KEY,
+                voice_channel_id INTEGER NOT NULL,
+                text_channel_id INTEGER,
+                current TEXT
+            );
+        """)
+
+    def append(self, guild_id, track):
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO queue (guild_id, position, data) "
+                "SELECT ?, COALESCE(MAX(position), 0) + 1, ? FROM queue WHERE guild_id = ?",
+                (guild_id, self.encode(track), guild_id),
+            )
+
+    def appendleft(self, guild_id, track):
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO queue (guild_id, position, data) "
+                "SELECT ?, COALESCE(MIN(position), 1) - 1, ? FROM queue WHERE guild_id = ?",
+                (guild_id, self.encode(track), guild_id),
+            )
+
+    def popleft(self, guild_id):
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT position, data FROM queue WHERE guild_id = ? ORDER BY position LIMIT 1", (guild_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute("DELETE FROM queue WHERE guild_id = ? AND position = ?", (guild_id, row[0]))
+        return self.decode(row[1])
+
+    def peek(self, guild_id, count=1):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT data FROM queue WHERE guild_id = ? ORDER BY position LIMIT ?", (guild_id, count)
+            ).fetchall()
+        return [self.decode(row[0]) for row in rows]
+
+    def length(self, guild_id):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM queue WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+
+    def clear(self, guild_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM queue WHERE guild_id = ?", (guild_id,))
+
+    def guilds(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute("SELECT DISTINCT guild_id FROM queue")]
+
+    def total_length(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def set_disconnect_deadline(self, guild_id, deadline):
+        with self._transaction() as db:
+            if deadline is None:
+                db.execute("DELETE FROM disconnect_deadlines WHERE guild_id = ?", (guild_id,))
+            else:
+                db.execute(
+                    "INSERT OR REPLACE INTO disconnect_deadlines (guild_id, deadline) VALUES (?, ?)",
+                    (guild_id, deadline),
+                )
+
+    def disconnect_deadline(self, guild_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT deadline FROM disconnect_deadlines WHERE guild_id = ?", (guild_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_session(self, guild_id, voice_channel_id, text_channel_id=None, current=None):
+        with self._transaction() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO sessions (guild_id, voice_channel_id, text_channel_id, current) "
+                "VALUES (?, ?, ?, ?)",
+                (guild_id, voice_channel_id, text_channel_id, self.encode(current) if current is not None else None),
+            )
+
+    def clear_session(self, guild_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM sessions WHERE guild_id = ?", (guild_id,))
+
+    def sessions(self):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT guild_id, voice_channel_id, text_channel_id, current FROM sessions"
+            ).fetchall()
+        return [
+            {"guild_id": row[0], "voice_channel_id": row[1], "text_channel_id": row[2],
+             "current": self.decode(row[3]) if row[3] is not None else None}
+            for row in rows
+        ]
+
+    def _transaction(self):
+        return _Transaction(self._lock, self._db)
+
+
+class _Transaction:
+    def __init__(self, lock, db):
+        self.lock = lock
+        self.db = db
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            for attempt in range(BUSY_RETRIES + 1):
+                try:
+                    self.db.execute("BEGIN IMMEDIATE")
+                    break
+                except sqlite3.OperationalError as e:
+                    if attempt == BUSY_RETRIES or "locked" not in str(e):
+                        log.warning("sqlite_begin_failed attempts=%s error=%s", attempt + 1, e)
+                        raise
+                    time.sleep(0.005 * 2 ** attempt)
+        except BaseException:
+            self.lock.release()
+            raise
+        return self.db
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.db.execute("ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.lock.release()
+
+
+def create_queue_store(kind=None, path=None, **kwargs):
+    "Build the store named by QUEUE_STORE (log, memory or sqlite)"
+    kind = (kind or os.getenv("QUEUE_STORE", "log")).lower()
+    if kind == "memory":
+        return MemoryQueueStore()
+    if kind == "log":
+        return LogQueueStore(path or os.getenv("QUEUE_LOG_PATH", "cache/queues.log"), **kwargs)
+    if kind == "sqlite":
+        return SQLiteQueueStore(path or os.getenv("QUEUE_STORE_PATH", "cache/queues.sqlite3"), **kwargs)
+    raise ValueError(f"Unknown QUEUE_STORE: {kind}")
@@ -0,0 +1,180 @@
+# On-disk cache for yt-dlp lookups so repeated /play queries skip extract_info
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+from query_classifier import classify
+
+DEFAULT_TTL = 6 * 60 * 60          # used when a stream URL carries no expiry of its own
+METADATA_TTL = 7 * 24 * 60 * 60    # how long titles and "query -> video id" mappings are trusted
+EXPIRY_MARGIN = 10 * 60            # drop stream URLs this long before googlevideo expires them
+log = logging.getLogger("musicbot.cache")
+
+STATS_EVERY = 100                  # print hit/miss counts every N lookups
+SCHEMA_VERSION = 2
+
+# Only the fields the bot reads back are stored; the stream URL is kept separately
+ENTRY_FIELDS = ("id", "title", "duration", "webpage_url", "ext", "acodec", "format_id")
+
+def stream_url_expiry(url, now=None):
+    "Work out when a googlevideo stream URL stops working, from its expire= parameter"
+    now = time.time() if now is None else now
+    try:
+        params = parse_qs(urlparse(url).query)
+        expire = float(params["expire"][0])
+    except (KeyError, IndexError, ValueError, TypeError):
+        return now + DEFAULT_TTL
+    return min(expire - EXPIRY_MARGIN, now + DEFAULT_TTL)
+
+
+def is_stream_entry(entry):
+    "Flat (extract_flat) entries only carry the watch page URL, not a playable stream"
+    return bool(entry.get("url")) and entry.get("_type") != "url"
+
+
+class SearchCache:
+    def __init__(self, path, max_entries=5000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()  # lookups run on executor threads
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            # It's only a cache, so an old layout is simply thrown away
+            self._db.executescript("DROP TABLE IF EXISTS videos; DROP TABLE IF EXISTS queries;")
+            self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS videos (
+                video_id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                stream_url TEXT,
+                stream_expires_at REAL NOT NULL DEFAULT 0,
+                last_used REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS queries (
+                query TEXT PRIMARY KEY,
+                video_id TEXT NOT NULL,
+                expires_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS videos_last_used ON videos(last_used);
+            CREATE INDEX IF NOT EXISTS queries_last_used ON queries(last_used);
+        """)
+        self._db.commit()
+
+    def get(self, query, need_stream=False):
+        """Return the cached entry for a query or YouTube URL, or None on a miss.
+
+        The entry only has a "url" key while its stream URL is still valid; with
+        need_stream, an entry without one is a miss, since the caller has to extract anyway.
+        """
+        now = time.time()
+        parsed = classify(query)
+        with self._lock:
+            key = parsed.cache_key
+            video_id = parsed.id if parsed.kind == "video" else None
+            if video_id is None:
+                row = self._db.execute(
+                    "SELECT video_id FROM queries WHERE query = ? AND expires_at > ?", (key, now)
+                ).fetchone()
+                video_id = row[0] if row else None
+            entry = self._get_video(video_id, now) if video_id else None
+            if entry is not None and need_stream and not is_stream_entry(entry):
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._db.execute("UPDATE queries SET last_used = ? WHERE query = ?", (now, key))
+            self._db.commit()
+            self._maybe_report()
+            return entry
+
+    def get_video(self, video_id):
+        "Return the cached entry for a video id, or None if missing or expired"
+        with self._lock:
+            entry = self._get_video(video_id, time.time())
+            self._db.commit()
+            return entry
+
+    def put(self, query, entry):
+        "Store an extracted entry under its video id and, for searches, the query that found it"
+        video_id = entry.get("id") if entry else None
+        if not video_id:
+            return
+        now = time.time()
+        data = {field: entry.get(field) for field in ENTRY_FIELDS}
+        stream_url = entry["url"] if is_stream_entry(entry) else None
+        with self._lock:
+            if stream_url is None:
+                # Keep a stream URL we already have when a flat search re-finds the video
+                self._db.execute(
+                    "INSERT INTO videos (video_id, data, expires_at, last_used) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(video_id) DO UPDATE SET data = excluded.data, "
+                    "expires_at = excluded.expires_at, last_used = excluded.last_used",
+                    (video_id, json.dumps(data), now + METADATA_TTL, now),
+                )
+            else:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO videos "
+                    "(video_id, data, expires_at, stream_url, stream_expires_at, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (video_id, json.dumps(data), now + METADATA_TTL, stream_url,
+                     stream_url_expiry(stream_url, now), now),
+                )
+            parsed = classify(query) if query else None
+            if parsed and parsed.kind != "video":
+                # Video links are found by their id; searches need the query -> video mapping
+                self._db.execute(
+                    "INSERT OR REPLACE INTO queries (query, video_id, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                    (parsed.cache_key, video_id, now + METADATA_TTL, now),
+                )
+            self._evict()
+            self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def _get_video(self, video_id, now):
+        row = self._db.execute(
+            "SELECT data, stream_url, stream_expires_at FROM videos WHERE video_id = ? AND expires_at > ?",
+            (video_id, now),
+        ).fetchone()
+        if row is None:
+            return None
+        self._db.execute("UPDATE videos SET last_used = ? WHERE video_id = ?", (now, video_id))
+        entry = json.loads(row[0])
+        if row[1] and row[2] > now:
+            entry["url"] = row[1]
+            entry["url_expires_at"] = row[2]
+        return entry
+
+    def _evict(self):
+        # Least recently used rows go first once a table is over its budget
+        for table in ("videos", "queries"):
+            count = self._db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            overflow = count - self.max_entries
+            if overflow > 0:
+                self._db.execute(
+                    f"DELETE FROM {table} WHERE rowid IN "
+                    f"(SELECT rowid FROM {table} ORDER BY last_used LIMIT ?)",
+                    (overflow,),
+                )
+
+    def _maybe_report(self):
+        if (self.hits + self.misses) % STATS_EVERY == 0:
+            stats = self.stats()
+            log.info("cache_stats hits=%s misses=%s hit_rate=%.2f", stats['hits'], stats['misses'], stats['hit_rate'])
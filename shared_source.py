@@ -0,0 +1,152 @@
+# One FFmpeg per (track, FFmpeg options) no matter how many guilds play it.
+# The first listener's reads pull Opus frames from FFmpeg into a shared buffer;
+# everyone else reads the same frames at their own offset
+import logging
+import threading
+from collections import deque
+
+log = logging.getLogger("musicbot.shared_source")
+
+FRAME_SECONDS = 0.02  # discord.py Opus frames are 20ms
+
+
+class SharedStream:
+    def __init__(self, key, source, join_frames, max_frames):
+        self.key = key
+        self.source = source
+        self.join_frames = join_frames  # a listener can join from the start until this many frames exist
+        self.max_frames = max_frames    # cap on buffered frames; listeners further behind get dropped
+        self.frames = deque()
+        self.base = 0       # offset of frames[0]
+        self.produced = 0   # offset of the next frame FFmpeg will hand out
+        self.finished = False
+        self.listeners = set()
+        self.lock = threading.Lock()          # guards the buffer and offsets
+        self.produce_lock = threading.Lock()  # one player thread reads FFmpeg at a time
+
+    def joinable(self):
+        return self.base == 0 and self.produced <= self.join_frames and not self.finished
+
+    def read(self, listener):
+        "Next frame for a listener; b'' at the end, None if it fell out of the buffer"
+        while True:
+            with self.lock:
+                if listener.offset < self.base:
+                    return None
+                if listener.offset < self.produced:
+                    frame = self.frames[listener.offset - self.base]
+                    listener.offset += 1
+                    self._trim()
+                    return frame
+                if self.finished:
+                    return b""
+            with self.produce_lock:
+                with self.lock:
+                    if self.produced > listener.offset or self.finished:
+                        continue  # another listener pulled it meanwhile
+                frame = self.source.read()
+                with self.lock:
+                    if frame:
+                        self.frames.append(frame)
+                        self.produced += 1
+                    else:
+                        self.finished = True
+
+    def _trim(self):
+        # Keep the start around while others may still join, then only what the slowest listener needs
+        if self.produced <= self.join_frames:
+            keep_from = 0
+        else:
+            keep_from = min((listener.offset for listener in self.listeners), default=self.produced)
+        keep_from = max(keep_from, self.produced - self.max_frames)
+        while self.base < keep_from:
+            self.frames.popleft()
+            self.base += 1
+
+
+class SharedSource:
+    "One guild's view of a SharedStream; quacks like a discord.AudioSource"
+    def __init__(self, broker, stream, location, options):
+        self.broker = broker
+        self.stream = stream
+        self.location = location
+        self.options = options
+        self.offset = 0
+        self.own_source = None  # private FFmpeg after falling out of the shared buffer
+
+    def read(self):
+        if self.own_source is not None:
+            return self.own_source.read()
+        frame = self.stream.read(self)
+        if frame is not None:
+            return frame
+        # Paused or too slow for the shared buffer: carry on alone from the same spot
+        log.info("shared_listener_dropped key=%s offset=%s", self.stream.key, self.offset)
+        self.broker.detach(self.stream, self)
+        self.own_source = self.broker.open_seeked(self.location, self.options, self.offset * FRAME_SECONDS)
+        return self.own_source.read()
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        if self.own_source is not None:
+            self.own_source.cleanup()
+            self.own_source = None
+        else:
+            self.broker.detach(self.stream, self)
+
+
+class SourceBroker:
+    def __init__(self, open_source, join_seconds=30, buffer_seconds=120):
+        self.open_source = open_source  # (location, ffmpeg options) -> FFmpeg audio source
+        self.join_frames = int(join_seconds / FRAME_SECONDS)
+        self.max_frames = max(int(buffer_seconds / FRAME_SECONDS), self.join_frames)
+        self.streams = {}  # key -> newest SharedStream, the one new listeners may join
+        self.active = set()
+        self._lock = threading.Lock()
+
+    def open(self, track_id, location, options):
+        "Attach to the track's shared stream, starting FFmpeg if nobody else is early enough in it"
+        key = (track_id, tuple(sorted(options.items())))
+        with self._lock:
+            stream = self.streams.get(key)
+            if stream is not None:
+                with stream.lock:
+                    if stream.joinable():
+                        source = SharedSource(self, stream, location, options)
+                        stream.listeners.add(source)
+                        log.debug("shared_stream_joined key=%s listeners=%s", key, len(stream.listeners))
+                        return source
+        # Spawning FFmpeg is slow, so not under the lock; a race only costs one extra process
+        stream = SharedStream(key, self.open_source(location, options), self.join_frames, self.max_frames)
+        source = SharedSource(self, stream, location, options)
+        stream.listeners.add(source)
+        with self._lock:
+            self.streams[key] = stream
+            self.active.add(stream)
+        return source
+
+    def open_seeked(self, location, options, seconds):
+        options = dict(options)
+        options["before_options"] = f"-ss {seconds:.2f} " + options.get("before_options", "")
+        return self.open_source(location, options)
+
+    def detach(self, stream, listener):
+        "Drop a listener; the last one out stops FFmpeg and frees the buffer"
+        with self._lock:
+            with stream.lock:
+                if listener not in stream.listeners:
+                    return  # cleanup() can run more than once
+                stream.listeners.discard(listener)
+                if stream.listeners:
+                    return
+                stream.frames.clear()
+            if self.streams.get(stream.key) is stream:
+                del self.streams[stream.key]
+            self.active.discard(stream)
+        stream.source.cleanup()
+
+    def stats(self):
+        with self._lock:
+            return {"streams": len(self.active), "listeners": sum(len(stream.listeners) for stream in self.active)}
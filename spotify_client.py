@@ -0,0 +1,170 @@
+# Non-blocking wrapper around spotipy: calls run on their own threads, track
+# metadata is cached, multi-track lookups are batched and 429s back off on the loop.
+# spotipy itself isn't imported here, so the client can be built on first use
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import metrics
+
+log = logging.getLogger("musicbot.spotify")
+
+TRACKS_BATCH = 50          # most ids the tracks endpoint takes per request
+PLAYLIST_PAGE = 100        # most items playlist_items returns per page
+ALBUM_PAGE = 50            # most items album_tracks returns per page
+PAGES_AHEAD = 2            # playlist/album pages requested before the caller gets to them
+MAX_RETRIES = 3
+DEFAULT_RETRY_AFTER = 5    # seconds, when a 429 comes without a Retry-After header
+RETRY_STATUSES = (500, 502, 503, 504)  # status_forcelist for spotipy; without 429, see make_spotify_client
+
+
+def track_info(track):
+    "The fields the bot uses from a Spotify track object"
+    return {
+        'id': track.get('id'),
+        'title': track['name'],
+        'artist': track['artists'][0]['name'] if track.get('artists') else "",
+        'is_explicit': track.get('explicit', False),
+        'duration_ms': track.get('duration_ms'),
+        'spotify_url': track.get('external_urls', {}).get('spotify'),
+    }
+
+
+class AsyncSpotify:
+    def __init__(self, client=None, max_cached_tracks=10000, max_concurrency=4, client_factory=None):
+        # The client should be built with retries=0/status_retries=0 so 429s reach us
+        # instead of being slept on inside a worker thread. With client_factory it is
+        # built (and spotipy imported) by the first request, on a worker thread
+        self._client = client
+        self._client_factory = client_factory
+        self._client_lock = threading.Lock()
+        self.max_cached_tracks = max_cached_tracks
+        self._tracks = OrderedDict()  # track id -> track_info(), least recently used first
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="spotify")
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._blocked_until = 0.0  # Spotify rate limits the whole app, so one 429 pauses every call
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self._client_factory()
+        return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    async def track(self, track_id):
+        return (await self.tracks([track_id]))[0]
+
+    async def tracks(self, track_ids):
+        "Look up several tracks, one request per 50 uncached ids, in the order given"
+        missing = [track_id for track_id in dict.fromkeys(track_ids) if track_id not in self._tracks]
+        batches = [missing[i:i + TRACKS_BATCH] for i in range(0, len(missing), TRACKS_BATCH)]
+        for result in await asyncio.gather(*(self._call(self._method("tracks"), batch) for batch in batches)):
+            for track in result['tracks']:
+                if track:
+                    self._remember(track_info(track))
+        return [self._cached(track_id) for track_id in track_ids]
+
+    async def iter_playlist_tracks(self, playlist_id):
+        "A playlist's tracks one page at a time, so huge playlists are never held whole"
+        fetch = partial(self._method("playlist_items"), playlist_id, additional_types=("track",))
+        async for page in self._iter_pages(fetch, PLAYLIST_PAGE):
+            for info in self._collect(item.get('track') for item in page['items']):
+                yield info
+
+    async def iter_album_tracks(self, album_id):
+        "An album's tracks one page at a time"
+        async for page in self._iter_pages(partial(self._method("album_tracks"), album_id), ALBUM_PAGE):
+            for info in self._collect(page['items']):
+                yield info
+
+    async def artist_top_tracks(self, artist_id, country="US"):
+        "An artist's top tracks (at most 10, one request)"
+        result = await self._call(self._method("artist_top_tracks"), artist_id, country=country)
+        return self._collect(result['tracks'])
+
+    def _collect(self, tracks):
+        infos = []
+        for track in tracks:
+            if not track or track.get('type', 'track') != 'track' or not track.get('name'):
+                continue
+            info = track_info(track)
+            if info['id']:
+                self._remember(info)
+            infos.append(info)
+        return infos
+
+    async def _iter_pages(self, fetch, page_size, ahead=PAGES_AHEAD):
+        # Up to `ahead` later pages are requested concurrently while the caller works
+        # through the current one; the first page says how many there are
+        pending = deque([asyncio.ensure_future(self._call(fetch, limit=page_size, offset=0))])
+        offset, total = page_size, None
+        try:
+            while pending:
+                page = await pending.popleft()
+                if total is None:
+                    total = page.get('total') or 0
+                if not page['items']:
+                    total = 0  # the list ended early (it shrank); don't ask for more
+                while len(pending) < ahead and offset < total:
+                    pending.append(asyncio.ensure_future(self._call(fetch, limit=page_size, offset=offset)))
+                    offset += page_size
+                yield page
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _call(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        for attempt in range(MAX_RETRIES + 1):
+            wait = self._blocked_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with self._semaphore:
+                try:
+                    with metrics.SPOTIFY_SECONDS.time():
+                        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+                except Exception as e:
+                    # spotipy.SpotifyException, matched by its status so spotipy needn't be imported
+                    if getattr(e, "http_status", None) != 429 or attempt == MAX_RETRIES:
+                        raise
+                    retry_after = _retry_after(e)
+            log.warning("spotify_rate_limited retry_after=%s", retry_after)
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+
+    def _method(self, name):
+        "A client method looked up when it runs, i.e. on the worker thread"
+        return lambda *args, **kwargs: getattr(self.client, name)(*args, **kwargs)
+
+    def _cached(self, track_id):
+        info = self._tracks.get(track_id)
+        if info is not None:
+            self._tracks.move_to_end(track_id)
+        return info
+
+    def _remember(self, info):
+        self._tracks[info['id']] = info
+        self._tracks.move_to_end(info['id'])
+        while len(self._tracks) > self.max_cached_tracks:
+            self._tracks.popitem(last=False)
+
+
+def _retry_after(error):
+    headers = getattr(error, 'headers', None) or {}
+    value = headers.get('Retry-After')
+    if value is None:
+        # Only happens if the client retries 429s itself, which hides the header
+        log.warning("spotify_retry_after_missing default=%s", DEFAULT_RETRY_AFTER)
+        return DEFAULT_RETRY_AFTER
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
@@ -0,0 +1,66 @@
+# Runs the bot as several worker processes, each owning a slice of the shards.
+# Usage: python supervisor.py [workers] [shards]  (defaults: one worker per CPU, one shard per worker)
+import logging
+import os
+import subprocess
+import sys
+import time
+
+from botlog import setup_logging
+
+log = logging.getLogger("musicbot.supervisor")
+
+RESTART_DELAY = 5  # seconds before a crashed worker is started again
+
+
+def shard_slices(shard_count, workers):
+    "Split shard ids 0..shard_count-1 into one contiguous slice per worker"
+    workers = min(workers, shard_count)
+    size, extra = divmod(shard_count, workers)
+    slices, start = [], 0
+    for worker in range(workers):
+        end = start + size + (1 if worker < extra else 0)
+        slices.append(list(range(start, end)))
+        start = end
+    return slices
+
+
+def start_worker(index, shard_ids, shard_count):
+    env = dict(os.environ)
+    env["SHARD_COUNT"] = str(shard_count)
+    env["SHARD_IDS"] = ",".join(str(shard_id) for shard_id in shard_ids)
+    # Workers only share queue state through a store they can all reach
+    env.setdefault("QUEUE_STORE", "sqlite")
+    # Each worker gets its own metrics port, counting up from METRICS_PORT
+    if int(env.get("METRICS_PORT", "0")):
+        env["METRICS_PORT"] = str(int(env["METRICS_PORT"]) + index)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MyBot.py")
+    log.info("worker_starting shards=%s", env['SHARD_IDS'])
+    return subprocess.Popen([sys.executable, script], env=env)
+
+
+def main():
+    setup_logging()
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else os.cpu_count() or 1
+    shard_count = int(sys.argv[2]) if len(sys.argv) > 2 else workers
+    slices = shard_slices(shard_count, workers)
+    processes = {index: start_worker(index, shard_ids, shard_count) for index, shard_ids in enumerate(slices)}
+    try:
+        while True:
+            time.sleep(1)
+            for index, process in processes.items():
+                if process.poll() is not None:
+                    log.warning("worker_exited shards=%s code=%s", slices[index], process.returncode)
+                    time.sleep(RESTART_DELAY)
+                    processes[index] = start_worker(index, slices[index], shard_count)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
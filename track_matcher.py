@@ -0,0 +1,62 @@
+# Picks the YouTube upload that best matches a Spotify track out of a handful of flat
+# search results, using only what a flat search returns (title, channel, duration)
+import re
+
+WORD_PATTERN = re.compile(r"[^\W_]+")
+
+# Words in a title that mean a different recording than the studio version,
+# unless the Spotify title has them too
+VERSION_MARKERS = ("live", "cover", "karaoke", "instrumental", "remix", "acoustic",
+                   "nightcore", "sped", "slowed", "reverb", "8d", "reaction")
+CLEAN_MARKERS = ("clean", "censored", "radio edit")
+DURATION_TOLERANCE = 30  # seconds off Spotify's length at which the duration stops counting
+
+
+def words(text):
+    return set(WORD_PATTERN.findall((text or "").lower()))
+
+
+def _overlap(wanted, found):
+    "Share of the words in `wanted` that show up in `found`"
+    return len(wanted & found) / len(wanted) if wanted else 0.0
+
+
+def score(entry, track_info):
+    "How likely a flat search entry is the Spotify track; higher is better"
+    title = (entry.get("title") or "").lower()
+    channel = entry.get("channel") or entry.get("uploader") or ""
+    title_words = words(title)
+    spotify_title = track_info.get("title") or ""
+    spotify_words = words(spotify_title)
+
+    points = 2.0 * _overlap(spotify_words, title_words)
+    points += 1.5 * _overlap(words(track_info.get("artist")), title_words | words(channel))
+
+    duration, duration_ms = entry.get("duration"), track_info.get("duration_ms")
+    if duration and duration_ms:
+        off = abs(duration - duration_ms / 1000)
+        points += 3.0 * (1 - min(off, DURATION_TOLERANCE) / DURATION_TOLERANCE)
+
+    for marker in VERSION_MARKERS:
+        if marker in title_words and marker not in spotify_words:
+            points -= 1.5
+    # The old match_filter dropped these outright; an explicit track never wants them,
+    # a clean one may be exactly the clean upload
+    if any(marker in title for marker in CLEAN_MARKERS) and not any(
+            marker in spotify_title.lower() for marker in CLEAN_MARKERS):
+        points -= 3.0 if track_info.get("is_explicit") else 1.0
+    if channel.endswith(" - Topic"):
+        points += 0.5  # YouTube Music's auto-generated uploads are the album audio
+    return points
+
+
+def best_match(entries, track_info):
+    "The best scoring entry, or None; ties go to YouTube's own order"
+    best, best_points = None, None
+    for rank, entry in enumerate(entries):
+        if not entry or not entry.get("id"):
+            continue
+        points = score(entry, track_info) - 0.1 * rank
+        if best_points is None or points > best_points:
+            best, best_points = entry, points
+    return best
@@ -0,0 +1,163 @@
+# Long-lived YoutubeDL instances served from their own executor, so extractions
+# don't rebuild extractors/cookie jars every time or starve the default executor
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import metrics
+
+log = logging.getLogger("musicbot.ytdl")
+
+STATS_EVERY = 100  # print timing stats every N extractions
+MAX_URL_HOPS = 3   # url results followed when a link redirects to another extractor
+_DONE = object()
+
+
+class ExtractorPool:
+    def __init__(self, profiles, max_workers=4, paging_workers=2):
+        self.profiles = profiles  # profile name -> YoutubeDL options
+        self.max_workers = max_workers
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ytdl")
+        # Paging a playlist holds its thread until the caller has taken every entry, so it
+        # gets its own threads; big playlists then can't leave /play without a worker
+        self.paging_executor = ThreadPoolExecutor(max_workers=paging_workers, thread_name_prefix="ytdl-paging")
+        # YoutubeDL isn't thread safe, so every worker thread keeps one instance per profile
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.extractions = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_extract = 0.0
+        self.max_extract = 0.0
+        self.pending = 0  # submitted jobs not finished yet, running or waiting for a worker
+
+    def submit(self, func, *args):
+        "Run func on the pool's executor; it receives the time it was queued as its first argument"
+        with self._stats_lock:
+            self.pending += 1
+        future = self.executor.submit(func, time.perf_counter(), *args)
+        future.add_done_callback(self._job_done)
+        return future
+
+    def _job_done(self, future):
+        with self._stats_lock:
+            self.pending -= 1
+
+    def saturation(self):
+        "How full the pool is: busy workers, jobs waiting for one, and busy/max_workers"
+        with self._stats_lock:
+            pending = self.pending
+        busy = min(pending, self.max_workers)
+        return {"busy": busy, "queued": pending - busy, "utilization": busy / self.max_workers}
+
+    def extract(self, query, profile, submitted):
+        "Extract info with this thread's instance for the profile; call from a pool thread"
+        started = time.perf_counter()
+        try:
+            return self._instance(profile).extract_info(query, download=False)
+        finally:
+            self._record(started - submitted, time.perf_counter() - started)
+
+    async def iter_entries(self, url, profile, buffer=100):
+        """Flat entries of a playlist as the extractor pages through it.
+
+        Extraction runs unprocessed (process=False) on a paging thread, so yt-dlp's lazy
+        entry generator fetches one page at a time and at most `buffer` entries wait
+        here for the caller. Closing the iterator early stops the extraction.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(buffer)
+        stop = threading.Event()
+
+        def put(item):
+            future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+            while not stop.is_set():
+                try:
+                    return future.result(timeout=0.5)
+                except FutureTimeoutError:
+                    continue
+            future.cancel()
+
+        def produce(submitted):
+            started = time.perf_counter()
+            count = 0
+            try:
+                ydl = self._instance(profile)
+                info = ydl.extract_info(url, download=False, process=False)
+                for _ in range(MAX_URL_HOPS):
+                    if not info or info.get("_type") not in ("url", "url_transparent"):
+                        break
+                    info = ydl.extract_info(info["url"], download=False, process=False)
+                if info and info.get("_type") in ("playlist", "multi_video"):
+                    entries = info.get("entries") or []
+                else:
+                    entries = [info] if info else []
+                for entry in entries:
+                    if stop.is_set():
+                        break
+                    if entry:
+                        put(entry)
+                        count += 1
+                put(_DONE)
+            except Exception as e:
+                put(e)
+            finally:
+                self._record(started - submitted, time.perf_counter() - started)
+                log.debug("playlist_extracted url=%s entries=%s seconds=%.1f", url, count, time.perf_counter() - started)
+
+        self.paging_executor.submit(produce, time.perf_counter())
+        try:
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            while not queue.empty():
+                queue.get_nowait()  # unblocks a put the producer may be waiting on
+
+    def stats(self):
+        with self._stats_lock:
+            count = self.extractions
+            return {
+                "extractions": count,
+                "avg_wait": self.total_wait / count if count else 0.0,
+                "max_wait": self.max_wait,
+                "avg_extract": self.total_extract / count if count else 0.0,
+                "max_extract": self.max_extract,
+            }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.paging_executor.shutdown(wait=False, cancel_futures=True)
+
+    def _instance(self, profile):
+        instances = getattr(self._local, "instances", None)
+        if instances is None:
+            instances = self._local.instances = {}
+        ydl = instances.get(profile)
+        if ydl is None:
+            import yt_dlp  # slow to import, so the first extraction pays for it instead of startup
+            ydl = instances[profile] = yt_dlp.YoutubeDL(self.profiles[profile])
+        return ydl
+
+    def _record(self, wait, extract):
+        metrics.EXTRACT_WAIT_SECONDS.observe(wait)
+        metrics.EXTRACT_SECONDS.observe(extract)
+        with self._stats_lock:
+            self.extractions += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.total_extract += extract
+            self.max_extract = max(self.max_extract, extract)
+            report = self.extractions % STATS_EVERY == 0
+        if report:
+            stats = self.stats()
+            log.info("ytdl_stats extractions=%s avg_wait=%.2f max_wait=%.2f avg_extract=%.2f max_extract=%.2f",
+                     stats['extractions'], stats['avg_wait'], stats['max_wait'],
+                     stats['avg_extract'], stats['max_extract'])